@@ -0,0 +1,49 @@
+"""parse the two MCPS address lines into number, street, unit, city, state and zip
+
+    "8204 Essex Ave Apt 2", "Chevy Chase, MD 20815"
+        -> Address(number="8204", street="Essex Ave", unit="Apt 2",
+                   city="Chevy Chase", state="MD", zip="20815")
+
+each line is matched by one precompiled pattern, and results are remembered per
+distinct address, so the By Street index, the street links in Full Details and the
+MemberHub City/State/Zip columns all share a single parse of each family's address.
+"""
+
+import functools
+import re
+from collections import namedtuple
+
+Address = namedtuple("Address", ["number", "street", "unit", "city", "state", "zip"])
+
+# " Unit ...", " Apt ...", " Floor ...", " Ste ...", " Suite ..." or " #..." through the end of
+# the line. the keyword may not run on into a lowercase word, so "Stewart Ave" is still a street
+UNIT = r"\s(?:(?:Unit|Apt|Floor|Ste|Suite)(?![a-z])|\#)"
+
+ADDRESS1_PATTERN = re.compile(
+    rf"""
+    ^(?P<number>\d+)(?!{UNIT})[ ]
+    (?P<street>(?:(?!{UNIT})[a-zA-Z0-9\s])+)
+    (?:.*?(?P<unit>{UNIT}.*))?
+    """,
+    re.VERBOSE,
+)
+
+ADDRESS2_PATTERN = re.compile(r"([\w\s+]+), (\w\w) (\d+)")
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def parse_address(address1, address2=None):
+    number = street = unit = city = state = zipcode = None
+
+    if address1:
+        if m := ADDRESS1_PATTERN.match(address1):
+            number, street, unit = m.group("number", "street", "unit")
+            if unit:
+                unit = unit.strip()
+
+    if address2:
+        if m := ADDRESS2_PATTERN.search(address2):
+            city, state, zipcode = m.groups()
+            city = city.strip()
+
+    return Address(number, street, unit, city, state, zipcode)
@@ -0,0 +1,530 @@
+"""sending the directory by email: a queue of messages delivered over a few authenticated
+SMTP connections that stay open for the whole run
+
+    with DeliveryEngine(username, password, journal=RecipientLedger(path)) as engine:
+        for message in ...:
+            engine.submit((normalize_address(message["To"]), version), message)
+    engine.failures  # {key: error} for what couldn't be sent
+
+a dropped connection is reopened and the message retried, sends are spaced to stay under
+the provider's caps, and every message sent is written to the ledger before the next one
+is taken, so a run that is interrupted can be started again without mailing anyone twice.
+host and port can point at a local stand-in, e.g. python -m aiosmtpd -n -l localhost:1025
+
+attachments are StreamedAttachments, base64 encoded onto the connection as they are sent,
+so a message never holds more than a block of its attachment in memory
+"""
+
+import base64
+import collections
+import contextlib
+import copy
+import email.generator
+import email.utils
+import io
+import json
+import mmap
+import os
+import pathlib
+import queue
+import re
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from email.mime.base import MIMEBase
+
+# gmail allows a workspace account 2000 messages a day, stay under it. its per minute limit
+# isn't published, 30 a minute has never been throttled
+gmail_daily_cap = 2000
+default_per_minute = 30
+
+day = 24 * 60 * 60
+
+
+def normalize_address(address):
+    """the bare, lowercased address in "Name <Someone@Example.com>", for telling recipients apart"""
+    name, bare = email.utils.parseaddr(address)
+    return (bare or address).strip().lower()
+
+
+class RecipientLedger:
+    """who was sent which version of the directory, in an sqlite file
+
+    a key is (address, version): the normalize_address of the recipient, and a hash of
+    the directory they were sent, so a recipient gets each version once. every key the
+    engine is handed is tracked through its states, for progress and for picking up the
+    retries in the next run
+
+        queued    submitted, not yet sent. left over if the run was killed
+        retrying  a send failed and is being tried again
+        failed    gave up, a rerun tries again
+        sent      done, a rerun skips it
+    """
+
+    schema = """
+        create table if not exists recipients (
+            address text not null,
+            version text not null,
+            state text not null,
+            attempts integer not null default 0,
+            error text,
+            updated real not null,
+            primary key (address, version)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # shared by the engine's connections, self.lock keeps them to one at a time
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute(self.schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, key, state, error=None, attempt=False):
+        address, version = key
+        with self.lock, self.db:
+            self.db.execute(
+                """
+                insert into recipients (address, version, state, attempts, error, updated)
+                values (?, ?, ?, ?, ?, ?)
+                on conflict (address, version) do update set
+                    state = excluded.state,
+                    attempts = attempts + excluded.attempts,
+                    error = excluded.error,
+                    updated = excluded.updated
+                """,
+                (address, version, state, int(attempt), error, time.time()),
+            )
+
+    def already_sent(self, key):
+        return self.state(key) == "sent"
+
+    def state(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "select state from recipients where address = ? and version = ?", key
+            ).fetchone()
+        return row[0] if row else None
+
+    def sent_since(self, when):
+        """times of the messages sent after when, oldest first"""
+        with self.lock:
+            rows = self.db.execute(
+                "select updated from recipients where state = 'sent' and updated > ? order by updated",
+                (when,),
+            ).fetchall()
+        return [updated for updated, in rows]
+
+    def queued(self, key):
+        self.update(key, "queued")
+
+    def record(self, key, recipients):
+        self.update(key, "sent", attempt=True)
+
+    def record_failure(self, key, error, final):
+        self.update(key, "failed" if final else "retrying", error=error, attempt=True)
+
+    def progress(self, version):
+        """{state: count} for the recipients of version"""
+        with self.lock:
+            rows = self.db.execute(
+                "select state, count(*) from recipients where version = ? group by state",
+                (version,),
+            ).fetchall()
+        return dict(rows)
+
+    def unsent(self, version):
+        """(address, state, attempts, error) for the recipients of version not yet sent"""
+        with self.lock:
+            return self.db.execute(
+                """
+                select address, state, attempts, error from recipients
+                where version = ? and state != 'sent' order by address
+                """,
+                (version,),
+            ).fetchall()
+
+    def versions(self):
+        """every version in the ledger, most recently sent to first"""
+        with self.lock:
+            rows = self.db.execute(
+                "select version from recipients group by version order by max(updated) desc"
+            ).fetchall()
+        return [version for version, in rows]
+
+    def import_journal(self, path):
+        """add what the json lines journal that came before the ledger says was sent"""
+        path = pathlib.Path(path)
+        if not path.is_file():
+            return
+        entries = []
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                # its keys were "{owner} {version}"
+                owner, _, version = entry["key"].rpartition(" ")
+                entries.append((normalize_address(owner), version, entry["at"]))
+        with self.lock, self.db:
+            self.db.executemany(
+                """
+                insert or ignore into recipients (address, version, state, attempts, updated)
+                values (?, ?, 'sent', 1, ?)
+                """,
+                entries,
+            )
+
+
+class StreamedAttachment(MIMEBase):
+    """a base64 attachment whose body stays in source until the message is sent
+
+    source is a path, which is memory mapped, or a bytes-like render buffer. send_streamed
+    encodes it a block at a time straight onto the connection; anything else that flattens
+    the message, as_string() say, gets a placeholder line instead of the body
+    """
+
+    # raw bytes per block, a whole number of 57 byte (76 character) base64 lines
+    block_size = 57 * 1024
+
+    def __init__(self, source, maintype, subtype, filename):
+        MIMEBase.__init__(self, maintype, subtype)
+        self.source = source
+        self.placeholder = f"<streamed attachment {uuid.uuid4().hex}>"
+        self.set_payload(self.placeholder)
+        self["Content-Transfer-Encoding"] = "base64"
+        self.add_header("Content-Disposition", "attachment", filename=filename)
+
+    def base64_blocks(self):
+        """the encoded body, CRLF line ends and all, a block at a time"""
+        with contextlib.ExitStack() as stack:
+            if isinstance(self.source, (str, os.PathLike)):
+                fh = stack.enter_context(open(self.source, "rb"))
+                if not os.fstat(fh.fileno()).st_size:
+                    return
+                data = stack.enter_context(
+                    mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+            else:
+                data = self.source
+            view = stack.enter_context(memoryview(data))
+            for start in range(0, len(view), self.block_size):
+                with view[start : start + self.block_size] as block:
+                    encoded = base64.encodebytes(block)
+                yield encoded.replace(b"\n", b"\r\n")
+
+
+def send_streamed(server, message):
+    """server.send_message(message) for a message with StreamedAttachments
+
+    the rest of the message is flattened as send_message would, then sent around the
+    attachments, which are encoded from their source as they go. returns the refused
+    recipients, like send_message
+    """
+    streamed = {
+        part.placeholder.encode("ascii"): part
+        for part in message.walk()
+        if isinstance(part, StreamedAttachment)
+    }
+    sender = message["Sender"] or message["From"]
+    from_addr = email.utils.getaddresses([sender])[0][1]
+    fields = [message[name] for name in ("To", "Bcc", "Cc") if message[name] is not None]
+    to_addrs = [address for name, address in email.utils.getaddresses(fields)]
+
+    message = copy.copy(message)
+    del message["Bcc"]
+    with io.BytesIO() as fh:
+        email.generator.BytesGenerator(fh).flatten(message, linesep="\r\n")
+        flat = fh.getvalue()
+    pieces = re.split(b"(" + b"|".join(map(re.escape, streamed)) + b")", flat)
+
+    server.ehlo_or_helo_if_needed()
+    code, reply = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+    refused = {}
+    for address in to_addrs:
+        code, reply = server.rcpt(address)
+        if code not in (250, 251):
+            refused[address] = (code, reply)
+    if len(refused) == len(to_addrs):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, reply = server.docmd("data")
+    if code != 354:
+        raise smtplib.SMTPDataError(code, reply)
+
+    for piece in pieces:
+        if piece in streamed:
+            # base64 has no periods to quote
+            for block in streamed[piece].base64_blocks():
+                server.send(block)
+        elif piece:
+            server.send(re.sub(rb"(?m)^\.", b"..", piece))
+    if not flat.endswith(b"\r\n"):
+        server.send(b"\r\n")
+    server.send(b".\r\n")
+    code, reply = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, reply)
+    return refused
+
+
+class RateLimiter:
+    """spaces sends 60 / per_minute seconds apart across every connection, and refuses once
+    daily_cap messages went out in the last 24 hours, counting those in the journal
+
+    each wait() holds a slot of the cap until the attempt is over: sent() keeps it,
+    release() gives it back, so attempts that fail don't use up the day's messages
+    """
+
+    def __init__(self, per_minute=default_per_minute, daily_cap=gmail_daily_cap, journal=None):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.daily_cap = daily_cap
+        self.next_at = 0
+        self.lock = threading.Lock()
+        recent = journal.sent_since(time.time() - day) if journal else []
+        self.recent = collections.deque(recent)
+        self.held = 0
+
+    def wait(self):
+        """sleep until the next send may go, returns False if today's cap is used up"""
+        with self.lock:
+            now = time.time()
+            while self.recent and self.recent[0] < now - day:
+                self.recent.popleft()
+            if self.daily_cap and len(self.recent) + self.held >= self.daily_cap:
+                return False
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+            self.held += 1
+        time.sleep(max(0, at - time.time()))
+        return True
+
+    def sent(self):
+        with self.lock:
+            self.held -= 1
+            self.recent.append(time.time())
+
+    def release(self):
+        with self.lock:
+            self.held -= 1
+
+
+class DeliveryEngine:
+    """sends submitted messages from a queue over connections SMTP connections
+
+    each connection is opened and logged in on its first message and kept for the rest.
+    a connection that drops, or a 4xx reply, is retried up to retries times with backoff;
+    a 5xx reply fails just that message. submit blocks while queue_size messages are
+    waiting, so a producer can't get far ahead of the network
+
+    blocked is the time submit spent waiting for room in the queue, busy the time spent in
+    send_message, summed over connections, and first_sent / last_sent bracket the sending
+    """
+
+    def __init__(
+        self,
+        username,
+        password,
+        host="smtp.gmail.com",
+        port=465,
+        connections=2,
+        per_minute=default_per_minute,
+        daily_cap=gmail_daily_cap,
+        journal=None,
+        retries=3,
+        backoff=2.0,
+        queue_size=8,
+        timeout=60,
+    ):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.journal = journal
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(per_minute, daily_cap, journal)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.sent = 0
+        self.skipped = 0
+        self.blocked = 0.0
+        self.busy = 0.0
+        self.first_sent = self.last_sent = None
+        # the SMTPAuthenticationError that stopped the run, nothing more is tried after it
+        self.login_failed = None
+        self.workers = [
+            threading.Thread(target=self.work, name=f"smtp-{i}", daemon=True)
+            for i in range(max(1, connections))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, key, message):
+        """queue message, unless key is already in the journal. key None is never journaled
+
+        raises the SMTPAuthenticationError once a login has failed, nothing more will be sent
+        """
+        if self.login_failed:
+            raise self.login_failed
+        if key is not None and self.journal:
+            if self.journal.already_sent(key):
+                with self.lock:
+                    self.skipped += 1
+                print(f"already sent {key}, skipping")
+                return False
+            self.journal.queued(key)
+        started = time.perf_counter()
+        self.queue.put((key, message))
+        with self.lock:
+            self.blocked += time.perf_counter() - started
+        return True
+
+    def close(self):
+        """send everything queued, then close the connections"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def connect(self):
+        if self.port == 465:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            server.ehlo()
+            if server.has_extn("starttls"):
+                server.starttls()
+                server.ehlo()
+        if self.password and server.has_extn("auth"):
+            server.login(self.username, self.password)
+        return server
+
+    def work(self):
+        server = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            key, message = item
+            if self.login_failed:
+                self.fail(key, message, f"not sent, login failed: {self.login_failed}")
+                continue
+            try:
+                server = self.deliver(server, key, message)
+            except Exception as e:
+                self.fail(key, message, repr(e))
+                server = disconnect(server)
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def deliver(self, server, key, message):
+        """send message, returns the connection to use for the next one"""
+        for attempt in range(self.retries + 1):
+            if not self.limiter.wait():
+                self.fail(key, message, "daily sending cap reached, rerun tomorrow")
+                return server
+            sent = False
+            try:
+                if server is None:
+                    server = self.connect()
+                started = time.perf_counter()
+                if any(isinstance(part, StreamedAttachment) for part in message.walk()):
+                    refused = send_streamed(server, message)
+                else:
+                    refused = server.send_message(message)
+                finished = time.perf_counter()
+                sent = True
+            except smtplib.SMTPAuthenticationError as e:
+                # every other message would fail the same way, stop rather than log in again
+                with self.lock:
+                    self.login_failed = self.login_failed or e
+                print(f"login as {self.username} failed, not sending anything more")
+                self.fail(key, message, f"{e.smtp_code} {e.smtp_error!r}")
+                return disconnect(server)
+            except smtplib.SMTPResponseException as e:
+                # 421 and friends are worth another go, 5xx won't change
+                if e.smtp_code >= 500 or attempt == self.retries:
+                    self.fail(key, message, f"{e.smtp_code} {e.smtp_error!r}")
+                    return server
+                error = e
+                server = disconnect(server)
+            except smtplib.SMTPRecipientsRefused as e:
+                self.fail(key, message, f"refused {sorted(e.recipients)}")
+                return server
+            except OSError as e:
+                # SMTPServerDisconnected, timeouts and resets, the connection is gone
+                if attempt == self.retries:
+                    self.fail(key, message, repr(e))
+                    return disconnect(server)
+                error = e
+                server = disconnect(server)
+            else:
+                recipients = message.get_all("To", [])
+                if key is not None and self.journal:
+                    self.journal.record(key, recipients)
+                with self.lock:
+                    self.sent += 1
+                    self.busy += finished - started
+                    if self.first_sent is None:
+                        self.first_sent = started
+                    self.last_sent = finished
+                print(f"sent {', '.join(recipients)}", f"(refused {refused})" if refused else "")
+                return server
+            finally:
+                # only what was sent counts against the daily cap
+                if sent:
+                    self.limiter.sent()
+                else:
+                    self.limiter.release()
+            if key is not None and self.journal:
+                self.journal.record_failure(key, repr(error), final=False)
+            wait = self.backoff * 2**attempt
+            print(f"{error!r} sending {key or message['To']}, retrying in {wait:.0f}s")
+            time.sleep(wait)
+        return server
+
+    def fail(self, key, message, error):
+        print(f"could not send to {message['To']}: {error}")
+        if key is not None and self.journal:
+            self.journal.record_failure(key, error, final=True)
+        with self.lock:
+            self.failures[key if key is not None else message["To"]] = error
+
+
+def disconnect(server):
+    """close server without caring how it went, returns None for the caller's connection"""
+    if server is not None:
+        try:
+            server.close()
+        except OSError:
+            pass
+    return None
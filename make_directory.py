@@ -1,161 +1,167 @@
 #!/usr/bin/env python
 
 import codecs
+import contextlib
+import functools
 import hashlib
+import io
 import os
 import pathlib
+import pickle
 import re
-import smtplib
+import shutil
 import sys
 import tempfile
+import time
 import traceback
+import types
 from copy import copy
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
 import click
-import qrcode
-import qrcode.image.svg
-import reportlab.platypus
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_RIGHT
-
-# from reportlab.lib.pagesizes import A6, letter
-from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.lib.units import inch
-from reportlab.platypus import Image, PageBreak, Paragraph, Spacer, Table
-from reportlab.platypus.doctemplate import BaseDocTemplate, PageTemplate
-from reportlab.platypus.flowables import BalancedColumns, KeepTogether
-from reportlab.platypus.frames import Frame
-from reportlab.platypus.tableofcontents import TableOfContents
-
-
-class MyDocTemplate(BaseDocTemplate):
-    def __init__(self, filename, **kw):
-        self.allowSplitting = 0
-        BaseDocTemplate.__init__(
-            self,
-            filename,
-            pagesize=(5.5 * inch, 8.5 * inch),
-            **kw,
-        )
-        template = PageTemplate(
-            "normal",
-            [
-                Frame(
-                    x1=0.25 * inch,
-                    y1=0.25 * inch,
-                    width=5 * inch,
-                    height=8 * inch,
-                    id="Frame1",
-                    # leftPadding=0.1 * inch,
-                    # showBoundary=1,
-                    showBoundary=0,
-                )
-            ],
-            onPage=AllPageSetup,
-        )
-        self.addPageTemplates(template)
 
-    def afterFlowable(self, flowable):
-        "Registers TOC entries."
-        if flowable.__class__.__name__ == "Paragraph":
-            text = flowable.getPlainText()
-            style = flowable.style.name
+from addresses import parse_address
 
-            if style == "TOCHeading1":
-                level = 0
-            elif style == "TOCHeading2":
-                level = 1
-            else:
-                return
+# reportlab, qrcode, smtplib and email are imported by the functions that use them, and the
+# reportlab based classes live in pdf_layout, so commands that never lay out a page start
+# quickly. see import-budget
 
-            E = [level, text, self.page]
-            # if we have a bookmark name append that to our notify data
-            bn = getattr(flowable, "_bookmarkName", None)
-            if bn is not None:
-                E.append(bn)
-            self.notify("TOCEntry", tuple(E))
 
+# --profile: where the time goes, by pipeline stage. see stage and print_stage_summary
+profile_stages = False
+stage_names = ["load", "normalize", "index", "story", "layout", "write", "email"]
+# name -> {"calls", "wall", "cpu", "peak_rss_kb"}, wall and cpu exclude nested stages
+stage_stats = {}
+stage_stack = []
+# --profile-layout: a cProfile.Profile enabled only while laying out, and where to dump it
+layout_profiler = None
+layout_profile_path = None
 
-def AllPageSetup(canvas, doc):
 
-    canvas.saveState()
+def peak_rss_kb():
+    import resource
 
-    canvas.setAuthor("Somerset ES PTA")
-    canvas.setTitle("Somerset ES 2024-2025 Directory")
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-    if doc.page == 1:
-        image_path = "somerset_es_directory_cover.jpg"
-        image_path = "somerset_es_directory_cover2.jpg"
-        image_path = "somerset-staff-photo-23-24-cropped.jpg"
-        image_path = "somerset_es_mary_vinograd.jpg"
-        page_width, page_height = canvas._pagesize
-        canvas.drawImage(
-            image_path,
-            0,
-            1.75 * inch,
-            width=5.5 * inch,
-            height=4 * inch,
-            preserveAspectRatio=True,
-        )
 
-        c = canvas
+def stage(name):
+    """with stage("layout"): ... accounts the block to that stage when --profile is on
 
-        # Cover Page Text with Drop Shadow
-        shadow_offset = 0.025 * inch
-        c.setFillColorRGB(0, 0, 0)
-        c.setFont("Helvetica", 60)
-        c.drawString(
-            shadow_offset + 0.3 * inch, -shadow_offset + 7.25 * inch, "Somerset ES"
-        )
-        c.drawString(
-            shadow_offset + 1 * inch, -shadow_offset + 6.25 * inch, "Directory"
+    stages nest, time spent in an inner stage is only counted there
+    """
+    if not profile_stages:
+        return contextlib.nullcontext()
+    return timed_stage(name)
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    frame = [time.perf_counter(), time.process_time(), 0.0, 0.0]
+    stage_stack.append(frame)
+    try:
+        yield
+    finally:
+        stage_stack.pop()
+        wall = time.perf_counter() - frame[0]
+        cpu = time.process_time() - frame[1]
+        if stage_stack:
+            stage_stack[-1][2] += wall
+            stage_stack[-1][3] += cpu
+        stats = stage_stats.setdefault(
+            name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_kb": 0}
         )
+        stats["calls"] += 1
+        stats["wall"] += wall - frame[2]
+        stats["cpu"] += cpu - frame[3]
+        stats["peak_rss_kb"] = max(stats["peak_rss_kb"], peak_rss_kb())
 
-        pos3_y = 0.75 * inch
-        c.drawString(shadow_offset + 0.8 * inch, -shadow_offset + pos3_y, "2024-2025")
 
-        c.setFillColorRGB(102 / 256, 153 / 256, 102 / 256)
-        c.drawString(0.3 * inch, 7.25 * inch, "Somerset ES")
-        c.drawString(1 * inch, 6.25 * inch, "Directory")
-        c.drawString(0.8 * inch, pos3_y, "2024-2025")
+def staged(name):
+    """decorator, the whole call is accounted to stage name"""
 
-        ## Draw a line
-        # c.setStrokeColorRGB(0,1,0.3) #choose your line color
-        # c.line(2,2,2*inch,2*inch)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            with stage(name):
+                return func(*args, **kw)
 
-        ## Draw a rectangle
-        # c.setFillColorRGB(1,1,0) #choose fill colour
-        # c.rect(4*inch,4*inch,2*inch,3*inch, fill=1) #draw rectangle
+        return wrapper
 
-    else:
+    return decorator
 
-        if doc.page > 4:
-            canvas.drawCentredString(2.75 * inch, 0.2 * inch, "Page %d" % (doc.page))
-        if hasattr(doc, "owner"):
-            canvas.setSubject(doc.owner)
-            # canvas.drawString(0.5 * inch, 0.5 * inch, doc.owner)
 
-            canvas.rotate(90)
-            fs = canvas._fontsize
-            canvas.translate(1, -fs / 1.2)  # canvas._leading?
-            canvas.drawString((3 + (doc.page / 100)) * inch, -0.05 * inch, doc.owner)
+def layout_profiling():
+    if layout_profiler is None:
+        return contextlib.nullcontext()
+    return layout_profiler
 
-        # header
-        # canvas.drawString(0.5 * inch, 8 * inch, doc.fund)
-        # canvas.drawRightString(10.5 * inch, 8 * inch, doc.report_info)
 
-        # footers
+def take_stage_stats():
+    """the stats recorded so far in this process, and forget them. used to collect from workers"""
+    out = dict(stage_stats)
+    stage_stats.clear()
+    if layout_profiler is not None:
+        layout_profiler.dump_stats(f"{layout_profile_path}.{os.getpid()}")
+    return out
+
 
-    canvas.restoreState()
+def merge_stage_stats(other):
+    for name, theirs in other.items():
+        stats = stage_stats.setdefault(
+            name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_kb": 0}
+        )
+        stats["calls"] += theirs["calls"]
+        stats["wall"] += theirs["wall"]
+        stats["cpu"] += theirs["cpu"]
+        stats["peak_rss_kb"] = max(stats["peak_rss_kb"], theirs["peak_rss_kb"])
+
+
+def print_stage_summary(started, cpu_started):
+    elapsed = time.perf_counter() - started
+    print(f"{'stage':<10} {'calls':>8} {'wall s':>10} {'cpu s':>10} {'% wall':>7} {'peak rss MB':>12}")
+    names = stage_names + sorted(set(stage_stats) - set(stage_names))
+    for name in names:
+        stats = stage_stats.get(name)
+        if not stats:
+            continue
+        print(
+            f"{name:<10} {stats['calls']:>8,d} {stats['wall']:>10.2f} {stats['cpu']:>10.2f}"
+            f" {100 * stats['wall'] / elapsed if elapsed else 0:>6.1f}% {stats['peak_rss_kb'] / 1024:>12.1f}"
+        )
+    print(
+        f"{'total':<10} {'':>8} {elapsed:>10.2f} {time.process_time() - cpu_started:>10.2f}"
+    )
+    print("wall and cpu are summed over --jobs workers, so may add up to more than the total")
+    if layout_profiler is not None:
+        layout_profiler.dump_stats(layout_profile_path)
+        print(f"layout profile written to {layout_profile_path}, and .<pid> for each worker")
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    "--profile/-no-profile",
+    default=False,
+    help="time each stage (load, normalize, index, story, layout, write, email) and summarize at exit",
+)
+@click.option(
+    "--profile-layout",
+    type=click.Path(dir_okay=False),
+    help="also write cProfile stats of the layout to this file, implies --profile",
+)
+@click.pass_context
+def cli(ctx, profile=False, profile_layout=None):
+    global profile_stages, layout_profiler, layout_profile_path
+    if profile or profile_layout:
+        profile_stages = True
+        if profile_layout:
+            import cProfile
+
+            layout_profiler = cProfile.Profile()
+            layout_profile_path = profile_layout
+        ctx.call_on_close(
+            functools.partial(
+                print_stage_summary, time.perf_counter(), time.process_time()
+            )
+        )
 
 
 @cli.command("make-all-pdfs")
@@ -175,33 +181,121 @@ def cli():
 @click.option(
     "--parents/-no-parents", default=False, help="prepare versions for parents"
 )
+@click.option(
+    "--overlay/-no-overlay",
+    default=False,
+    help="layout the directory once, then stamp each owner onto the built pages",
+)
+@click.option(
+    "--jobs",
+    default=1,
+    type=int,
+    help="number of processes used to build the personalized pdfs",
+)
+@click.option(
+    "--cache/-no-cache", default=True, help="reuse the parsed --src from the roster cache"
+)
+@click.option(
+    "--incremental/-no-incremental",
+    default=False,
+    help="report what changed since the last run, and skip the single pdf if nothing did",
+)
+@click.option(
+    "--on-overflow",
+    type=click.Choice(["shrink", "drop", "fail"]),
+    default="shrink",
+    help="what to do with a block too large for a page",
+)
+@click.option(
+    "--layout-jobs",
+    default=1,
+    type=int,
+    help="lay out the sections of each pdf in this many processes",
+)
+@click.option(
+    "--stream/-no-stream",
+    default=False,
+    help="lay out each pdf as its story is made, holding one section at a time",
+)
+@click.option(
+    "--mail-connections",
+    default=2,
+    type=int,
+    help="number of SMTP connections --send delivers over",
+)
 @click.pass_context
 def make_all_pdfs(
-    ctx, src, board=False, staff=False, parents=False, pages=None, send=False
+    ctx,
+    src,
+    board=False,
+    staff=False,
+    parents=False,
+    pages=None,
+    send=False,
+    overlay=False,
+    jobs=1,
+    cache=True,
+    incremental=False,
+    on_overflow="shrink",
+    layout_jobs=1,
+    stream=False,
+    mail_connections=2,
 ):
     """setup whatever is needed"""
 
-    pool = xlsx_to_pool(src)
-    story = pool_to_story(pool)
+    loaders = [xlsx_to_pool, xlsx_to_emails] if parents else [xlsx_to_pool]
+    with contextlib.ExitStack() as stack:
+        # one open workbook for every loader the roster cache can't answer
+        sheet = None
+        if not cache or not all(roster_cache_path(x, src).is_file() for x in loaders):
+            sheet = stack.enter_context(open_xlsx(src))
+        with stage("load"):
+            pool = cached_roster(xlsx_to_pool, src, sheet=sheet, use_cache=cache)
+            if parents:
+                emails = cached_roster(xlsx_to_emails, src, sheet=sheet, use_cache=cache)
     single_pdf = "somerset_directory.pdf"
-
-    if pages:
-        story_to_pdf(story, filename=single_pdf)
+    base_pdf = single_pdf if pages else "mypdf1.pdf"
+
+    index = DirectoryIndex(pool)
+    with stage("index"):
+        snapshot = directory_snapshot(index)
+    if incremental and not directory_changes(base_pdf, snapshot):
+        print(f"nothing changed since {base_pdf} was made, not rebuilding it")
+    elif pages:
+        if not directory_to_pdf(
+            pool,
+            index=index,
+            filename=single_pdf,
+            overflow=on_overflow,
+            layout_jobs=layout_jobs,
+            stream=stream,
+        ):
+            raise click.ClickException(f"could not lay out {single_pdf}")
+        save_directory_snapshot(base_pdf, snapshot)
 
         from PyPDF2 import PdfReader, PdfWriter
 
-        inputpdf = PdfReader(open(single_pdf, "rb"))
+        with stage("write"):
+            inputpdf = PdfReader(open(single_pdf, "rb"))
 
-        for i in range(len(inputpdf.pages)):
-            output = PdfWriter()
-            output.add_page(inputpdf.pages[i])
-            with open(
-                f"pages/somerset-es-directory-page{i:05d}.pdf", "wb"
-            ) as outputStream:
-                output.write(outputStream)
+            for i in range(len(inputpdf.pages)):
+                output = PdfWriter()
+                output.add_page(inputpdf.pages[i])
+                with open(
+                    f"pages/somerset-es-directory-page{i:05d}.pdf", "wb"
+                ) as outputStream:
+                    output.write(outputStream)
     else:
-
-        story_to_pdf(story)
+        if not directory_to_pdf(
+            pool,
+            index=index,
+            filename=base_pdf,
+            overflow=on_overflow,
+            layout_jobs=layout_jobs,
+            stream=stream,
+        ):
+            raise click.ClickException(f"could not lay out {base_pdf}")
+        save_directory_snapshot(base_pdf, snapshot)
 
     # do_filter = False
 
@@ -231,42 +325,20 @@ def make_all_pdfs(
     load_dotenv()
     password = os.environ["SOMERSETPTA_DIRECTORY_PASSWORD"]
 
+    # (owner, filename, email it?) in the order they were requested
+    todo = []
+
     if board:
         for owner in pta_board:
-            story = pool_to_story(pool)
-            safe_owner = make_filename_safe(owner)
-            filename = f"unfiltered/somerset_directory_for_{safe_owner}.pdf"
-            print(owner, filename)
-            story_to_pdf(
-                story,
-                owner=owner,
-                filename=filename,
-            )
-
-            stream = as_email(
-                username=login_username,
-                recipients=[owner],
-                attachment=filename,
-            )
-            if send:
-                send_emails(username=login_username, password=password, messages=stream)
+            todo.append((owner, personalized_filename(owner), True))
 
     if staff:
         for staff_member in staff_order:
             owner = staff_member.get("email")
             if owner:
-                story = pool_to_story(pool)
-                safe_owner = make_filename_safe(owner)
-                filename = f"unfiltered/somerset_directory_for_{safe_owner}.pdf"
-                print(owner, filename)
-                story_to_pdf(
-                    story,
-                    owner=owner,
-                    filename=filename,
-                )
+                todo.append((owner, personalized_filename(owner), False))
 
     if parents:
-        emails = xlsx_to_emails(src)
         for owner, students in emails.items():
             if "levitas" not in owner.lower():
                 continue
@@ -288,36 +360,411 @@ def make_all_pdfs(
                 #     filename=filename,
                 # )
 
-                story = pool_to_story(pool)
-                safe_owner = make_filename_safe(owner)
-                filename = f"unfiltered/somerset_directory_for_{safe_owner}.pdf"
-                print(owner, filename)
-                story_to_pdf(
-                    story,
-                    owner=owner,
-                    filename=filename,
-                )
+                todo.append((owner, personalized_filename(owner), True))
 
-                stream = as_email(
-                    username=login_username,
-                    recipients=[owner],
-                    # subject=subject,
-                    # body=body,
-                    attachment=filename,
-                )
-                if send:
-                    send_emails(
-                        username=login_username, password=password, messages=stream
+    mailer = None
+    if send:
+        mailer = DirectoryMailer(
+            todo,
+            username=login_username,
+            password=password,
+            version=directory_version(pool, index=index),
+            connections=mail_connections,
+        )
+    with mailer or contextlib.nullcontext():
+        if mailer:
+            todo = mailer.unsent(todo)
+        failures = render_personalized_pdfs(
+            todo,
+            pool,
+            base_pdf=base_pdf if overlay else None,
+            jobs=jobs,
+            index=index,
+            overflow=on_overflow,
+            layout_jobs=layout_jobs,
+            stream=stream,
+            on_built=mailer.mail if mailer else None,
+        )
+
+    if todo:
+        print_personalized_summary(todo, failures)
+
+    print_identifier_cache_stats()
+
+
+class DirectoryMailer:
+    """emails the (owner, filename, mail?) in todo that are to be mailed, as they are built
+
+    render_personalized_pdfs calls mail() with each copy it finishes, and the message goes
+    on the queue of a DeliveryEngine whose connections send it while the next copies are
+    rendered. mail() blocks while that queue is full, so rendering is never more than a
+    queue ahead of sending. each address gets a version of the directory once, the
+    recipient ledger under cache_dir remembers who was sent what. version is the
+    directory_version of the pool the copies are made from
+    """
+
+    def __init__(self, todo, username, password, version, connections=2):
+        self.wanted = {filename for owner, filename, mail in todo if mail}
+        self.username = username
+        self.password = password
+        self.version = version
+        self.connections = connections
+        self.engine = None
+
+    def __enter__(self):
+        from delivery import DeliveryEngine
+
+        self.ledger = open_mail_ledger()
+        self.started = time.perf_counter()
+        self.engine = DeliveryEngine(
+            self.username,
+            self.password,
+            host=smtp_host,
+            port=smtp_port,
+            connections=self.connections,
+            journal=self.ledger,
+        )
+        return self
+
+    def __exit__(self, *exc):
+        with stage("email"):
+            self.engine.close()
+        self.print_throughput()
+        print_mail_progress(self.ledger, self.version)
+        self.ledger.close()
+
+    def key(self, owner):
+        from delivery import normalize_address
+
+        return (normalize_address(owner), self.version)
+
+    def unsent(self, todo):
+        """todo less the copies for addresses that already have this version, or that
+        appear earlier in todo, so neither is rendered just to be skipped at sending"""
+        kept = []
+        seen = set()
+        already = duplicates = 0
+        for owner, filename, mail in todo:
+            if mail:
+                key = self.key(owner)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                if self.ledger.already_sent(key):
+                    already += 1
+                    continue
+            kept.append((owner, filename, mail))
+        self.wanted = {filename for owner, filename, mail in kept if mail}
+        print(
+            f"email: {len(self.wanted)} to send, {already} already have this version, "
+            f"{duplicates} duplicate addresses"
+        )
+        return kept
+
+    @property
+    def failures(self):
+        return self.engine.failures
+
+    def mail(self, owner, filename):
+        import smtplib
+
+        if filename not in self.wanted:
+            return
+        with stage("email"):
+            for message in as_email(
+                username=self.username,
+                recipients=[owner],
+                # subject=subject,
+                # body=body,
+                attachment=filename,
+            ):
+                try:
+                    self.engine.submit(self.key(owner), message)
+                except smtplib.SMTPAuthenticationError as e:
+                    raise click.ClickException(
+                        f"could not log in to {smtp_host} as {self.username}: {e.smtp_code} {e.smtp_error!r}"
                     )
 
+    def print_throughput(self):
+        engine = self.engine
+        elapsed = time.perf_counter() - self.started
+        sending = (engine.last_sent - engine.first_sent) if engine.sent else 0.0
+        rate = engine.sent / sending if sending else 0.0
+        print(
+            f"email: {engine.sent} sent, {engine.skipped} already sent, "
+            f"{len(engine.failures)} failed, {rate:.2f}/s over {sending:.1f}s of {elapsed:.1f}s. "
+            f"{engine.busy:.1f}s in send_message, rendering waited {engine.blocked:.1f}s for the send queue"
+        )
+
+
+def open_mail_ledger():
+    from delivery import RecipientLedger
+
+    mail_dir = pathlib.Path(cache_dir) / "mail"
+    ledger = RecipientLedger(mail_dir / "recipients.sqlite")
+    # what was sent before there was a ledger
+    ledger.import_journal(mail_dir / "journal.jsonl")
+    return ledger
+
+
+def print_mail_progress(ledger, version, verbose=False):
+    progress = ledger.progress(version)
+    total = sum(progress.values())
+    counts = ", ".join(f"{n} {state}" for state, n in sorted(progress.items()))
+    print(f"version {version[:12]}: {total} recipients, {counts or 'none yet'}")
+    for address, state, attempts, error in ledger.unsent(version):
+        if verbose or state == "failed":
+            print(f"\t{address}\t{state}\t{attempts} attempts\t{error or ''}")
+
+
+def personalized_filename(owner):
+    safe_owner = make_filename_safe(owner)
+    return f"unfiltered/somerset_directory_for_{safe_owner}.pdf"
+
+
+def personalized_pdf(
+    pool,
+    owner,
+    filename,
+    base_pdf=None,
+    index=None,
+    overflow="shrink",
+    layout_jobs=1,
+    stream=False,
+):
+    """returns True if filename was written"""
+    if base_pdf:
+        stamp_pdf(base_pdf, owner=owner, filename=filename)
+        return True
+    else:
+        return directory_to_pdf(
+            pool,
+            index=index,
+            owner=owner,
+            filename=filename,
+            overflow=overflow,
+            layout_jobs=layout_jobs,
+            stream=stream,
+        )
+
+
+# per process state for render_personalized_pdfs, set once by the pool initializer
+personalized_worker_state = {}
+
+
+def init_personalized_worker(
+    pool,
+    base_pdf,
+    index=None,
+    overflow="shrink",
+    profile=None,
+    layout_jobs=1,
+    stream=False,
+):
+    global profile_stages, layout_profiler, layout_profile_path
+    if profile is not None:
+        # a forked worker starts with a copy of the parent's stats, only report its own
+        stage_stats.clear()
+        profile_stages, layout_profile_path = profile
+        if layout_profile_path:
+            import cProfile
+
+            layout_profiler = cProfile.Profile()
+    personalized_worker_state["pool"] = pool
+    personalized_worker_state["base_pdf"] = base_pdf
+    personalized_worker_state["index"] = index
+    personalized_worker_state["overflow"] = overflow
+    personalized_worker_state["layout_jobs"] = layout_jobs
+    personalized_worker_state["stream"] = stream
+
+
+def personalized_worker(owner, filename):
+    """returns None on success, or the formatted traceback"""
+    try:
+        written = personalized_pdf(
+            personalized_worker_state["pool"],
+            owner,
+            filename,
+            base_pdf=personalized_worker_state["base_pdf"],
+            index=personalized_worker_state["index"],
+            overflow=personalized_worker_state["overflow"],
+            layout_jobs=personalized_worker_state["layout_jobs"],
+            stream=personalized_worker_state["stream"],
+        )
+    except Exception:
+        return traceback.format_exc()
+    if not written:
+        return f"could not lay out {filename}"
+    return None
+
+
+def pooled_personalized_worker(owner, filename):
+    """personalized_worker, plus the stage stats it recorded, for --jobs"""
+    error = personalized_worker(owner, filename)
+    return error, take_stage_stats() if profile_stages else {}
+
+
+def worker_context():
+    """the multiprocessing context for a process pool started now
+
+    fork, so workers share this process's roster and story rather than unpickling a copy
+    each. but a forked child only gets the thread that forked it, and can deadlock on a lock
+    one of the others held (the mail senders printing, say), so while other threads are
+    running the workers come from a forkserver and their initargs are pickled
+    """
+    import multiprocessing
+    import threading
+
+    if threading.active_count() > 1:
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("fork")
+
+
+def render_personalized_pdfs(
+    todo,
+    pool,
+    base_pdf=None,
+    jobs=1,
+    index=None,
+    overflow="shrink",
+    layout_jobs=1,
+    stream=False,
+    on_built=None,
+):
+    """build every (owner, filename, ...) in todo, returns {filename: traceback} for the failures
+
+    on_built(owner, filename) is called with each copy as soon as it is written. with jobs > 1
+    only 2 * jobs copies are in flight at a time, so a slow on_built holds rendering back
+    rather than letting finished pdfs pile up
+    """
+    os.makedirs("unfiltered", exist_ok=True)
+    started = time.perf_counter()
+
+    # the same person may be on several lists, only build their copy once
+    owners = {}
+    for owner, filename, *_ in todo:
+        owners.setdefault(filename, owner)
+
+    failures = {}
+    if jobs <= 1:
+        init_personalized_worker(
+            pool, base_pdf, index, overflow, layout_jobs=layout_jobs, stream=stream
+        )
+        for filename, owner in owners.items():
+            print(owner, filename)
+            error = personalized_worker(owner, filename)
+            if error:
+                print(error)
+                failures[filename] = error
+            elif on_built:
+                on_built(owner, filename)
+    else:
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=worker_context(),
+            initializer=init_personalized_worker,
+            initargs=(
+                pool,
+                base_pdf,
+                index,
+                overflow,
+                (profile_stages, layout_profile_path),
+                layout_jobs,
+                stream,
+            ),
+        ) as executor:
+            waiting = iter(owners.items())
+            in_flight = {}
+
+            def top_up():
+                for filename, owner in waiting:
+                    future = executor.submit(pooled_personalized_worker, owner, filename)
+                    in_flight[future] = filename
+                    if len(in_flight) >= 2 * jobs:
+                        break
+
+            top_up()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename = in_flight.pop(future)
+                    try:
+                        error, worker_stats = future.result()
+                        merge_stage_stats(worker_stats)
+                    except Exception:
+                        error = traceback.format_exc()
+                    print(owners[filename], filename, "failed" if error else "done")
+                    if error:
+                        print(error)
+                        failures[filename] = error
+                    elif on_built:
+                        on_built(owners[filename], filename)
+                top_up()
+
+    elapsed = time.perf_counter() - started
+    built = len(owners) - len(failures)
+    if owners:
+        print(
+            f"render: {built} built, {len(failures)} failed, "
+            f"{built / elapsed if elapsed else 0:.2f}/s over {elapsed:.1f}s"
+        )
+    return failures
+
+
+def print_personalized_summary(todo, failures):
+    seen = set()
+    for owner, filename, *_ in todo:
+        if filename in seen:
+            continue
+        seen.add(filename)
+        status = "FAILED" if filename in failures else "ok"
+        print(f"{status:6} {owner} {filename}")
+    print(f"{len(seen) - len(failures)} built, {len(failures)} failed")
+
 
 @cli.command("refresh")
 @click.option("--src", help="MCPS export .xlsx", required=False)
 @click.option(
     "--parents/-no-parents", default=False, help="prepare versions for parents"
 )
+@click.option(
+    "--incremental/-no-incremental",
+    default=False,
+    help="report what changed since the last run, and skip the pdf if nothing did",
+)
+@click.option(
+    "--on-overflow",
+    type=click.Choice(["shrink", "drop", "fail"]),
+    default="shrink",
+    help="what to do with a block too large for a page",
+)
+@click.option(
+    "--layout-jobs",
+    default=1,
+    type=int,
+    help="lay out the sections of each pdf in this many processes",
+)
+@click.option(
+    "--stream/-no-stream",
+    default=False,
+    help="lay out each pdf as its story is made, holding one section at a time",
+)
 @click.pass_context
-def refresh_the_pdf(ctx, src, board=False, staff=False, parents=False, pages=None):
+def refresh_the_pdf(
+    ctx,
+    src,
+    board=False,
+    staff=False,
+    parents=False,
+    pages=None,
+    incremental=False,
+    on_overflow="shrink",
+    layout_jobs=1,
+    stream=False,
+):
     """live from google sheet to google drive"""
 
     src_url = "https://docs.google.com/spreadsheets/d/1YdQkan1JDiUqyGh30ugO-TuVnr1xySHcCi1n9Tlx-oc/edit"
@@ -335,11 +782,27 @@ def refresh_the_pdf(ctx, src, board=False, staff=False, parents=False, pages=Non
     sh = gc.open_by_url(src_url)
     worksheet = sh.get_worksheet(0)
 
-    pool = xlsx_to_pool(src, sheet=worksheet)
-    story = pool_to_story(pool)
+    with stage("load"):
+        pool = xlsx_to_pool(src, sheet=worksheet)
     single_pdf = "somerset_directory.pdf"
 
-    story_to_pdf(story, filename=single_pdf)
+    index = DirectoryIndex(pool)
+    with stage("index"):
+        snapshot = directory_snapshot(index)
+    if incremental and not directory_changes(single_pdf, snapshot):
+        print(f"nothing changed since {single_pdf} was made, not rebuilding it")
+        return
+
+    if not directory_to_pdf(
+        pool,
+        index=index,
+        filename=single_pdf,
+        overflow=on_overflow,
+        layout_jobs=layout_jobs,
+        stream=stream,
+    ):
+        raise click.ClickException(f"could not lay out {single_pdf}")
+    save_directory_snapshot(single_pdf, snapshot)
 
 
 def make_filename_safe(filename):
@@ -393,44 +856,13 @@ def pool_to_teacher_grade(pool):
 
 
 def pool_to_teacher_grade_student_uids(pool):
-    out = {}
-    tg = pool_to_teacher_grade(pool)
-    for grade in tg:
-        out[grade] = {}
-        for teacher in tg[grade]:
-            student_uids = []
-            for entry in tg[grade][teacher]:
-                astudent_uid = student_uid(entry)
-                if astudent_uid not in student_uids:
-                    student_uids.append(astudent_uid)
-            out[grade][teacher] = student_uids
-    return out
+    return DirectoryIndex(pool).by_class
 
 
 def get_street(address1):
     if address1 is None:
-        out = None
-    else:
-        out = "unknown"
-    src = address1
-
-    if src:
-        src = re.sub(r" Unit.*$", "", src)
-        src = re.sub(r" Apt.*$", "", src)
-        src = re.sub(r" Floor.*$", "", src)
-        src = re.sub(r" Ste.*$", "", src)
-        src = re.sub(r" Suite.*$", "", src)
-        src = re.sub(r" #.*$", "", src)
-        src = re.sub(r" Unit.*$", "", src)
-    if src:
-        m = re.search(r"^\d{1,} ([a-zA-Z0-9\s]+)", src)
-        if m:
-            out = m.group(1)
-        else:
-            pass
-
-    # print(f"address1: [{address1}] street: [{out}]")
-    return out
+        return None
+    return parse_address(address1).street or "unknown"
 
 
 def student_uid(entry):
@@ -442,7 +874,7 @@ def student_uid(entry):
         # teacher = entry.get("Homeroom Teacher")
         student_ustr = student_name + str(dob)
 
-    uid = hashlib.sha1(student_ustr.encode("utf-8")).hexdigest()
+    uid = hash_student_ustr(student_ustr)
     return uid
 
 
@@ -451,14 +883,95 @@ def class_uid(grade=None, teacher=None, entry=None):
         grade = get_grade(entry)
     if teacher is None:
         teacher = get_teacher(entry)
-    uid = hashlib.sha1((f"{grade}_{teacher}").encode("utf-8")).hexdigest()
+    uid = hash_class(grade, teacher)
     return uid
 
 
-def pool_to_student_relations(pool):
+# student_uid, class_uid, street_url and linkedHeading hash the same few keys over and over,
+# once per row per section. bounded so a district sized roster can't grow them without limit
+identifier_cache_size = 1 << 16
+
+
+@functools.lru_cache(maxsize=identifier_cache_size)
+def hash_student_ustr(student_ustr):
+    return hashlib.sha1(student_ustr.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=identifier_cache_size)
+def hash_class(grade, teacher):
+    return hashlib.sha1((f"{grade}_{teacher}").encode("utf-8")).hexdigest()
+
 
+@functools.lru_cache(maxsize=identifier_cache_size)
+def heading_bookmark(text, style_name):
+    return hashlib.sha1((text + style_name).encode("utf-8")).hexdigest()
+
+
+def identifier_cache_stats():
+    """{name: (hits, misses, size)} for each memoized identifier hash"""
     out = {}
-    for entry in pool:
+    for func in [hash_student_ustr, hash_class, street_url, heading_bookmark]:
+        info = func.cache_info()
+        out[func.__name__] = (info.hits, info.misses, info.currsize)
+    return out
+
+
+def print_identifier_cache_stats():
+    for name, (hits, misses, size) in identifier_cache_stats().items():
+        print(f"{name}: {hits:,d} hits {misses:,d} misses {size:,d} cached")
+
+
+def pool_to_student_relations(pool):
+    return DirectoryIndex(pool).students
+
+
+class DirectoryIndex:
+    """every lookup the directory, memberhub export and email fan-out need, built in one pass over pool
+
+    students     student_uid -> {"Student", "Grade", "Homeroom Teacher", "Relations", ...}
+                 as pool_to_student_relations has always returned
+    by_class     grade -> teacher -> [student_uid], ordered as pool_to_teacher_grade
+    by_lastname, by_firstname, by_street, by_family, by_email
+                 key -> [student_uid], in pool order
+    class_uids   student_uid -> [class_uid] (normally one)
+    family_ids   family key (see family_key) -> "famNNN", numbered in pool order
+    """
+
+    def __init__(self, pool):
+        self.students = {}
+        self.by_lastname = {}
+        self.by_firstname = {}
+        self.by_street = {}
+        self.by_family = {}
+        self.by_email = {}
+        self.class_uids = {}
+        self.family_ids = {}
+
+        classes = {}
+        with stage("normalize"):
+            for entry in pool:
+                self.add(entry, classes)
+        with stage("index"):
+            self.build(classes)
+
+    def build(self, classes):
+        self.by_class = self.sorted_classes(classes)
+
+        for uid, student in self.students.items():
+            self.collapse_relations(student)
+
+            student_name = student["Student"]
+            if ", " in student_name:
+                lastname, firstname = student_name.split(", ", 1)
+                self.by_lastname.setdefault(lastname, []).append(uid)
+                self.by_firstname.setdefault(firstname, []).append(uid)
+
+            street_name = get_street(student.get("Address1"))
+            if street_name:
+                self.by_street.setdefault(street_name, []).append(uid)
+                # I would prefer perfect sorting of addresses, but too many records have 1 child withheld, while the other is given an address
+
+    def add(self, entry, classes):
         student_name = entry.get("Student")
         # dob = entry.get("Birth Date")
         grade = get_grade(entry)
@@ -475,13 +988,14 @@ def pool_to_student_relations(pool):
         relation_email = entry.get("Parent/Guardian Email") or entry.get("Email")
 
         uid = student_uid(entry)
-        if uid not in out:
-            out[uid] = {}
-        out[uid]["Student"] = student_name
-        out[uid]["Grade"] = grade
-        out[uid]["Homeroom Teacher"] = teacher
-        if "Relations" not in out[uid]:
-            out[uid]["Relations"] = []
+        if uid not in self.students:
+            self.students[uid] = {}
+        student = self.students[uid]
+        student["Student"] = student_name
+        student["Grade"] = grade
+        student["Homeroom Teacher"] = teacher
+        if "Relations" not in student:
+            student["Relations"] = []
 
         relation_info = {
             "Relation": relation,
@@ -496,29 +1010,74 @@ def pool_to_student_relations(pool):
             relation_info["Address2"] = address2
         if phone != withheld_marker:
             relation_info["Phone"] = phone
-        out[uid]["Relations"].append(relation_info)
-
-    for uid in out:
-        all_relations = out[uid]["Relations"]
+        student["Relations"].append(relation_info)
+
+        # dicts as ordered sets, a student is listed once however many guardian rows they have
+        classes.setdefault(grade, {}).setdefault(teacher, {})[uid] = None
+        aclass_uid = class_uid(grade=grade, teacher=teacher)
+        class_uids = self.class_uids.setdefault(uid, [])
+        if aclass_uid not in class_uids:
+            class_uids.append(aclass_uid)
+
+        family = self.family_key(entry)
+        if family not in self.family_ids:
+            self.family_ids[family] = f"fam{123 + len(self.family_ids)}"
+        family_uids = self.by_family.setdefault(family, [])
+        if uid not in family_uids:
+            family_uids.append(uid)
+
+        if relation_email:
+            email_uids = self.by_email.setdefault(relation_email.lower(), [])
+            if uid not in email_uids:
+                email_uids.append(uid)
+
+    @staticmethod
+    def family_key(entry):
+        """the home address, or failing that the guardian's phone"""
+        address1, address2 = get_address12(entry)
+        if address1 and address1.strip():
+            return address1
+        return get_relation_phone(entry)
+
+    def family_id(self, entry):
+        return self.family_ids[self.family_key(entry)]
+
+    @staticmethod
+    def sorted_classes(classes):
+        sorted_out = {
+            "SE PreK": {},
+            "K": {},
+        }
+        for grade in sorted(classes):
+            sorted_out[grade] = {}
+            for teacher in sorted(classes[grade]):
+                sorted_out[grade][teacher] = list(classes[grade][teacher])
+        return sorted_out
+
+    @staticmethod
+    def collapse_relations(student):
+        """lift values every guardian shares up onto the student"""
+        all_relations = student["Relations"]
         for k in ["Address1", "Address2", "Phone", "Email", "Cell Phone"]:
             all_vals = set([rel.get(k) for rel in all_relations])
             if all_vals == {None}:
                 continue
             if len(all_vals) == 1:
-                out[uid][k] = all_vals.pop()
+                student[k] = all_vals.pop()
                 for rel in all_relations:
                     del rel[k]
-        out[uid]["Relations"] = all_relations
-        if out[uid].get("Cell Phone") and out[uid].get("Phone") == out[uid].get(
+        student["Relations"] = all_relations
+        if student.get("Cell Phone") and student.get("Phone") == student.get(
             "Cell Phone"
         ):
-            del out[uid]["Cell Phone"]
-    return out
+            del student["Cell Phone"]
 
 
 def linkedHeading(story, text, style):
+    from reportlab.platypus import Paragraph
+
     # create bookmarkname
-    bn = hashlib.sha1((text + style.name).encode("utf-8")).hexdigest()
+    bn = heading_bookmark(text, style.name)
     # modify paragraph text to include an anchor point with name bn
     h = Paragraph(text + '<a name="%s"/>' % bn, style)
     # store the bookmark name on the flowable so afterFlowable can see this
@@ -534,40 +1093,102 @@ def url2qrlink(url):
     return url2qr(url2link(url))
 
 
+# QR matrices are content addressed under .pta_cache/qr, trimmed back to this size
+# oldest first
+qr_cache_max_bytes = 4 * 1024 * 1024
+
+# QR codes made since the last drain, waiting for render_qr_codes to hand them a matrix
+qr_pending = []
+
+
+def qr_cache_path(url):
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return pathlib.Path(cache_dir) / "qr" / f"{digest}.pickle"
+
+
+def make_qr_matrix(url):
+    """rows of booleans (True is dark), quiet zone included"""
+    import qrcode
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=1,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+
+@functools.lru_cache(maxsize=1024)
+def qr_matrix(url):
+    """the matrix for url, from memory, the QR cache, or made now and cached"""
+    path = qr_cache_path(url)
+    if path.is_file():
+        with open(path, "rb") as fh:
+            return pickle.load(fh)
+    matrix = make_qr_matrix(url)
+    save_qr_matrix(url, matrix)
+    evict_qr_cache()
+    return matrix
+
+
+def save_qr_matrix(url, matrix):
+    path = qr_cache_path(url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_path, "wb") as fh:
+        pickle.dump(matrix, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def render_qr_codes(jobs=None):
+    """give every pending QR code its matrix, making the ones not cached yet in parallel"""
+    urls = {f.url for f in qr_pending}
+    missing = [url for url in urls if not qr_cache_path(url).is_file()]
+    jobs = jobs or os.cpu_count() or 1
+    # a matrix takes a few ms, not worth a worker until there are a good many
+    if len(missing) >= 64 and jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=min(jobs, len(missing)), mp_context=worker_context()
+        ) as executor:
+            matrices = executor.map(make_qr_matrix, missing, chunksize=16)
+            for url, matrix in zip(missing, matrices):
+                save_qr_matrix(url, matrix)
+        evict_qr_cache()
+    for f in qr_pending:
+        f.matrix = qr_matrix(f.url)
+    qr_pending.clear()
+
+
+def evict_qr_cache(max_bytes=None):
+    """delete the least recently used QR matrices until the cache fits in max_bytes"""
+    if max_bytes is None:
+        max_bytes = qr_cache_max_bytes
+    paths = list((pathlib.Path(cache_dir) / "qr").glob("*.pickle"))
+    stats = {path: path.stat() for path in paths}
+    total = sum(st.st_size for st in stats.values())
+    for path in sorted(paths, key=lambda x: max(stats[x].st_atime, stats[x].st_mtime)):
+        if total <= max_bytes:
+            break
+        total -= stats[path].st_size
+        path.unlink(missing_ok=True)
+
+
 def url2qr(url):
+    """a QR code for url, its matrix is filled in by render_qr_codes when its section drains"""
+    from pdf_layout import QRCode
 
-    label = "myqr1_" + hashlib.sha1(url.encode("utf-8")).hexdigest()
-    out_fn = f"img-{label}-minimal.png"
-    if not pathlib.Path(out_fn).is_file():
-        # check filesystem and reuse if possible
-
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            # error_correction=qrcode.constants.ERROR_CORRECT_M,
-            # error_correction=qrcode.constants.ERROR_CORRECT_Q,
-            # error_correction=qrcode.constants.ERROR_CORRECT_H,
-            box_size=40,
-            border=1,
-        )
-
-        body = url
-        qr.add_data(body)
-        qr.make(fit=True)
-
-        factory = qrcode.image.pure.PyPNGImage
-        img = qr.make_image(
-            # fill_color="green",
-            # back_color="purple",
-            image_factory=factory,
-        )
-        outfh = open(out_fn, "wb")
-        img.save(outfh)
-    out = Image(out_fn, 1 * inch, 1 * inch)
-    return out
+    qr = QRCode(url, None)
+    qr_pending.append(qr)
+    return qr
 
 
 def url4story(url, style):
+    from reportlab.platypus import Paragraph, Spacer
+
     return [
         Paragraph(
             url2link(url),
@@ -578,105 +1199,59 @@ def url4story(url, style):
     ]
 
 
-def pool_to_story(pool):
+@staged("story")
+def pool_to_story(pool, index=None):
+    return list(pool_to_story_stream(pool, index=index))
 
-    styles = getSampleStyleSheet()
-    # styles.add(ParagraphStyle(name="Justify", alignment=TA_JUSTIFY))
 
-    toch1 = ParagraphStyle(
-        name="TOCHeading1",
-        fontSize=14,
-        leading=16,
-        spaceBefore=10,
-        spaceAfter=10,
-    )
-    # tcoh2 = ParagraphStyle(
-    #     name="TOCHeading2",
-    #     fontSize=12,
-    #     leading=18,
-    #     spaceBefore=10,
-    #     spaceAfter=10,
-    # )
+def drain(flowables):
+    """yield then forget everything in flowables, once their QR codes have matrices"""
+    render_qr_codes()
+    yield from flowables
+    flowables.clear()
 
-    # h1 = ParagraphStyle(
-    #     name="Heading1",
-    #     fontSize=14,
-    #     leading=16,
-    #     spaceBefore=10,
-    #     spaceAfter=10,
-    # )
-    h2 = ParagraphStyle(
-        name="Heading2",
-        fontSize=12,
-        leading=18,  # fontName="Helvetica-Bold",
-        spaceBefore=10,
-        spaceAfter=10,
-    )
-    h3 = ParagraphStyle(
-        # firstLineIndent=30,
-        spaceBefore=10,
-        # spaceAfter=45,
-        name="Heading2",
-        fontSize=10,
-        leading=22,
-        fontName="Helvetica",
-    )
 
-    styleSheet = getSampleStyleSheet()
+def pool_to_story_stream(pool, index=None):
+    """the flowables of pool_to_story, yielded a section (or a student) at a time
 
-    # body_style = styleSheet["BodyText"]
+    nothing that has been yielded is kept here, so a consumer like stream_to_pdf only ever
+    holds the part of the directory it is laying out
+    """
+    from reportlab.lib import colors
 
-    teacher_style = ParagraphStyle(
-        name="teacher",
-        fontSize=14,
-        leading=20,  # leftIndent=15
-        fontName="Helvetica-Bold",
-    )
+    # from reportlab.lib.pagesizes import A6, letter
+    from reportlab.platypus import PageBreak, Paragraph, Spacer, Table
+    from reportlab.platypus.flowables import BalancedColumns, KeepTogether
+    from reportlab.platypus.tableofcontents import TableOfContents
 
-    teacher_email_style = ParagraphStyle(
-        name="teacher_email",
-        fontSize=14,
-        leading=20,
-        leftIndent=15,
-        # fontName="Helvetica-Bold",
-    )
+    from pdf_layout import StudentRecord, directory_styles
 
-    details_student_name_style = ParagraphStyle(
-        name="studentName", fontSize=12, leading=15, leftIndent=0
-    )
-    details_class_teacher_style = ParagraphStyle(
-        name="details_teacher", fontSize=10, leftIndent=10  # leading=12,
-    )
-    details_phone_style = ParagraphStyle(
-        name="phone",
-        fontSize=10,
-        # leading=12,
-        leftIndent=10,
-    )
-    details_address_style = ParagraphStyle(
-        name="address",
-        fontSize=10,
-        # leading=12,
-        leftIndent=10,
-    )
+    if index is None:
+        index = DirectoryIndex(pool)
 
-    student_street_style = ParagraphStyle(
-        name="studentStreet", fontSize=12, leading=14, leftIndent=20
-    )
-    student_teacher_style = ParagraphStyle(
-        name="studentTeacher", fontSize=12, leading=14, leftIndent=20
-    )
-    # style = styles["Normal"]
-    normal = styles["Normal"]
+    styles = directory_styles()
+    # styles.add(ParagraphStyle(name="Justify", alignment=TA_JUSTIFY))
+
+    toch1 = styles.toch1
+    h2 = styles.h2
+    h3 = styles.h3
+
+    teacher_style = styles.teacher
+    teacher_email_style = styles.teacher_email
 
-    centered_title_style = styles["Heading1"]
-    centered_title_style.alignment = 1
+    details_student_name_style = styles.details_student_name
+    details_class_teacher_style = styles.details_class_teacher
+    details_phone_style = styles.details_phone
+    details_address_style = styles.details_address
 
-    centered_subtitle_style = styles["Heading2"]
-    centered_subtitle_style.alignment = 1
+    student_street_style = styles.student_street
+    student_teacher_style = styles.student_teacher
+    # style = styles["Normal"]
+    normal = styles.normal
 
-    centered_style = copy(styles["Normal"])
-    centered_style.alignment = 1
+    centered_title_style = styles.centered_title
+    centered_subtitle_style = styles.centered_subtitle
+    centered_style = styles.centered
 
     Story = []
 
@@ -736,14 +1311,13 @@ def pool_to_story(pool):
     Story.append(Paragraph("Published by the Somerset PTA", centered_style))
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     toc = TableOfContents()
     # toc.levelStyles = [h1]#, h2]
     Story.append(toc)
 
-    style_right = ParagraphStyle(
-        name="right", parent=styles["Normal"], alignment=TA_RIGHT
-    )
+    style_right = styles.right
 
     if True:
 
@@ -1223,6 +1797,7 @@ def pool_to_story(pool):
         )
 
     Story.append(PageBreak())
+    yield from drain(Story)
     ptext = "FAQ"
     linkedHeading(Story, ptext, toch1)
 
@@ -2073,6 +2648,7 @@ def pool_to_story(pool):
     )
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     linkedHeading(Story, "Q & A", toch1)
 
@@ -2266,6 +2842,7 @@ def pool_to_story(pool):
     )
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     if True:
         Story.append(PageBreak())
@@ -2310,34 +2887,11 @@ def pool_to_story(pool):
             Story.append(KeepTogether(t))
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
-    psr = pool_to_student_relations(pool)
+    psr = index.students
     num_students = 0
 
-    by_lastname = {}
-    by_firstname = {}
-    by_street = {}
-    by_homeroom = {}
-
-    for student_uid, student in psr.items():
-        num_students += 1
-        student_name = student["Student"]
-
-        lastname, firstname = student_name.split(", ")
-        by_lastname.setdefault(lastname, []).append(student_uid)
-        by_firstname.setdefault(firstname, []).append(student_uid)
-
-        address1 = student.get("Address1")
-        street_name = get_street(address1)
-        if street_name:
-            by_street.setdefault(street_name, []).append(student_uid)
-            # I would prefer perfect sorting of addresses, but too many records have 1 child withheld, while the other is given an address
-
-        grade = get_grade(student)
-        teacher = get_teacher(student)
-        homeroom_key = f"{grade} {teacher}"
-        by_homeroom.setdefault(homeroom_key, []).append(student_uid)
-
     linkedHeading(Story, "Full Details by Last Name", toch1)
 
     for student_uid in psr:
@@ -2384,8 +2938,6 @@ def pool_to_story(pool):
                     if key not in data_keys:
                         data_keys.append(key)
 
-        offset_width = 10
-        # relationship_width = 0.65
         for relation in student["Relations"]:
             data_row = []
             any_values = [x for x in relation.values() if x != withheld_marker]
@@ -2393,52 +2945,24 @@ def pool_to_story(pool):
                 for key in data_keys:
                     value = relation.get(key)
                     if value and value != withheld_marker:
-                        data_row.append(
-                            Paragraph(value, styleSheet["BodyText"]),
-                        )
+                        data_row.append(value)
                     else:
                         data_row.append(None)
             if data_row:
                 ready = [None]
                 ready.extend(data_row)
                 data.append(ready)
-        if data:
-            num_cols = len(data[0])
-            # col_width = (5 * inch - offset_width) / (num_cols - 1)
-            # col_widths = [.75*inch] + [col_width] * (num_cols-1)
-            col_widths = [offset_width] + [None] * (num_cols - 2)
-            t = Table(
-                data,
-                hAlign="RIGHT",
-                # colWidths=[2.4 * inch, 2.5 * inch, 2.5 * inch],
-                colWidths=col_widths,
-                style=[
-                    ("LINEABOVE", (1, 0), (-1, -1), 0.25, colors.black),
-                    ("LINEBELOW", (1, 0), (-1, -1), 0.25, colors.black),
-                    ("LINEBEFORE", (2, 0), (-1, -1), 0.25, colors.black),
-                    # ("GRID", (0,0), (-1, -1), 0.5, colors.black),
-                    ("VALIGN", (0, 0), (-1, -1), "TOP"),
-                    ("LEFTPADDING", (0, 0), (0, -1), 0),
-                    ("LEFTPADDING", (1, 0), (-1, -1), 1),
-                    # ('LEFTPADDING', (-1,0), (-1, -1), 1),
-                    ("RIGHTPADDING", (0, 0), (-1, -1), 1),
-                    ("TOPPADDING", (0, 0), (-1, -1), 0),
-                    ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
-                    # ('FONTSIZE', (0, 0), (-1, -1), 16),
-                    # ('leftIndent', (0, 0), (1, -1), 10)
-                ],
-            )
-
-            kt.append(t)
-        Story.append(KeepTogether(kt))
+        Story.append(StudentRecord(kt, data))
+        yield from drain(Story)
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     ptext = "By Grade & Teacher"
     linkedHeading(Story, ptext, toch1)
     Story.append(Spacer(1, 12))
 
-    tgs = pool_to_teacher_grade_student_uids(pool)
+    tgs = index.by_class
     for grade in tgs:
         for teacher in tgs[grade]:
             aclass_uid = class_uid(grade=grade, teacher=teacher)
@@ -2459,15 +2983,17 @@ def pool_to_story(pool):
                 agroup.append(p)
 
             Story.append(KeepTogether(agroup))
+            yield from drain(Story)
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     ptext = "By First Name"
     linkedHeading(Story, ptext, toch1)
 
     name_flow = []
-    for firstname in sorted(by_firstname):
-        for student_uid in by_firstname[firstname]:
+    for firstname in sorted(index.by_firstname):
+        for student_uid in index.by_firstname[firstname]:
             student = psr[student_uid]
             student_name = student.get("Student")
             alastname, afirstname = student_name.split(", ")
@@ -2475,17 +3001,18 @@ def pool_to_story(pool):
             student_link = (
                 f"<link href='#{student_uid}'>{afirstname} {alastname}</link>"
             )
-            p = Paragraph(student_link, styleSheet["BodyText"])
+            p = Paragraph(student_link, styles.body_text)
             name_flow.append(p)
     Story.append(BalancedColumns(name_flow))
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     ptext = "By Street"
     linkedHeading(Story, ptext, toch1)
     Story.append(Spacer(1, 12))
 
-    for street_name in sorted(by_street):
+    for street_name in sorted(index.by_street):
 
         astreet_url = street_url(street_name)
         if astreet_url:
@@ -2494,14 +3021,16 @@ def pool_to_story(pool):
             street_anchor = street_name
 
         Story.append(Paragraph(street_anchor, h2))
-        for student_uid in by_street[street_name]:
+        for student_uid in index.by_street[street_name]:
             student = psr[student_uid]
             student_name = student.get("Student")
             student_link = f"\u2022 <link href='#{student_uid}'>{student_name}</link>"
             p = Paragraph(student_link, student_street_style)
             Story.append(p)
+        yield from drain(Story)
 
     Story.append(PageBreak())
+    yield from drain(Story)
 
     ptext = "About This Directory"
     linkedHeading(Story, ptext, toch1)
@@ -2527,93 +3056,1132 @@ def pool_to_story(pool):
         )
     )
 
-    return Story
+    yield from drain(Story)
+
+
+def directory_to_pdf(
+    pool,
+    index=None,
+    owner=None,
+    filename="mypdf1.pdf",
+    overflow="shrink",
+    layout_jobs=1,
+    stream=False,
+):
+    """lay out the directory of pool into filename, returns True if it was written
+
+    with stream the flowables are laid out as pool_to_story_stream makes them, see
+    stream_to_pdf. laying out sections in parallel needs the whole story, so layout_jobs > 1
+    takes precedence over stream
+    """
+    if index is None:
+        index = DirectoryIndex(pool)
+    if stream and layout_jobs <= 1:
+        return stream_to_pdf(
+            lambda: pool_to_story_stream(pool, index=index),
+            owner=owner,
+            filename=filename,
+            overflow=overflow,
+            fingerprint=directory_fingerprint(index),
+        )
+    story = pool_to_story(pool, index=index)
+    return story_to_pdf(
+        story, owner=owner, filename=filename, overflow=overflow, jobs=layout_jobs
+    )
+
+
+@staged("layout")
+def story_to_pdf(
+    Story, owner=None, filename="mypdf1.pdf", overflow="shrink", jobs=1
+):
+    """lay out Story into filename, returns True if it was written
+
+    if the layout fails, every flowable that can't fit on a page by itself is found in one
+    pass (see find_overflowing_flowables), reported, and handled according to overflow:
+    "shrink" scales it down to fit the frame, "drop" replaces it with a short note,
+    "fail" gives up without writing filename. then the layout is retried once
 
+    with jobs > 1 the sections are laid out in that many processes, see sections_to_pdf.
+    if that fails, the whole story is laid out here as usual
+    """
+    from reportlab.platypus.doctemplate import LayoutError
+    from reportlab.platypus.tableofcontents import TableOfContents
+
+    from pdf_layout import MyDocTemplate
+
+    if jobs > 1:
+        try:
+            if sections_to_pdf(Story, owner=owner, filename=filename, jobs=jobs):
+                return True
+        except LayoutError as e:
+            print(f"{filename}: {e}")
+        print(f"{filename}: laying out the sections in parallel failed, one process it is")
 
-def story_to_pdf(Story, owner=None, filename="mypdf1.pdf"):
     tmppdf = tempfile.NamedTemporaryFile(suffix=".pdf")
-    doc = MyDocTemplate(tmppdf.name)
-    if owner:
-        doc.owner = owner
 
     success = False
-    try:
-        doc.multiBuild(Story)
-        success = True
-    except reportlab.platypus.doctemplate.LayoutError as e:
-        print(e)
-        breakpoint()
-        # pdb.set_trace()
-        while not success:
-            try:
-                doc.build(Story)
-            except Exception as e:
-                print("Unexpected error:", sys.exc_info()[0])
-                print("exception:", e)
-                print("error:", sys.exc_info()[1])
-                traceback.print_exc(file=sys.stdout)
-                print("removing %s" % Story[0])
-                Story = Story[1:]
+    for attempt in range(2):
+        doc = MyDocTemplate(tmppdf.name)
+        if owner:
+            doc.owner = owner
+        tocs = [f for f in Story if isinstance(f, TableOfContents)]
+        fingerprint = story_fingerprint(Story) if tocs and use_toc_cache else None
+        seeded = seed_tocs(tocs, fingerprint)
+        try:
+            with layout_profiling():
+                doc.multiBuild(Story)
+            success = True
+            if fingerprint and seeded != toc_entries(tocs):
+                save_toc_entries(fingerprint, tocs)
+            break
+        except LayoutError as e:
+            print(e)
+            if attempt:
+                break
+
+        overflowing = find_overflowing_flowables(Story)
+        verdict = "giving up" if overflow == "fail" else f"will {overflow} it"
+        for i, section, description in overflowing:
+            print(f"{filename}: {section or 'front matter'}: {description} does not fit on a page, {verdict}")
+        if not overflowing:
+            print(f"{filename}: no single flowable is too large, not retrying")
+            break
+        if overflow == "fail":
+            break
+        Story = fit_overflowing_flowables(Story, overflowing, overflow)
 
     if success:
         from shutil import copyfile
 
-        copyfile(tmppdf.name, filename)
+        with stage("write"):
+            copyfile(tmppdf.name, filename)
     else:
         print(f"failed to make {filename}")
 
-    return
+    return success
 
 
-withheld_marker = "(withheld)"
+class FlowableStream(list):
+    """a story for BaseDocTemplate.build that is topped up from an iterator as it is consumed
 
+    build only works at the front of its list: it takes flowables off flowables[0], puts
+    split remainders back there, and looks a few ahead for keepWithNext. so the list only
+    holds the next lookahead flowables, refilled every time build asks for its length.
+    on_flowable(flowable) is called for each one as it comes in
+    """
 
-def xlsx_to_pool(src, sheet=None):
-    if sheet is None:
-        from openpyxl import load_workbook
+    lookahead = 64
 
-        wb = load_workbook(filename=src)
-        sheet = wb.active
-    else:
-        pass
+    def __init__(self, flowables, on_flowable=None):
+        super().__init__()
+        self.source = iter(flowables)
+        self.on_flowable = on_flowable
 
-    # col_labels = sheet.row_values(1)
-    col_labels = [x.value for x in next(sheet.rows)]
+    def __len__(self):
+        while self.source is not None and super().__len__() < self.lookahead:
+            try:
+                with stage("story"):
+                    flowable = next(self.source)
+            except StopIteration:
+                self.source = None
+                break
+            if self.on_flowable:
+                self.on_flowable(flowable)
+            self.append(flowable)
+        return super().__len__()
+
+
+@staged("layout")
+def stream_to_pdf(
+    make_stream,
+    owner=None,
+    filename="mypdf1.pdf",
+    overflow="shrink",
+    fingerprint=None,
+    max_passes=10,
+):
+    """lay out the flowables of make_stream() into filename, returns True if it was written
 
-    col_clean_labels = [x.strip() for x in col_labels]
-    clean_col = {x: y for x, y in zip(col_labels, col_clean_labels)}
+    like multiBuild, the document is laid out until its table of contents stops changing,
+    but each pass lays out a fresh make_stream() rather than a copy of a whole story, so
+    only a section or so is ever in memory. the contents are seeded from the TOC cache
+    entry for fingerprint, then from the previous pass. if the layout fails, the whole
+    story is made after all and handed to story_to_pdf to deal with what overflowed
+    """
+    from reportlab.platypus.doctemplate import LayoutError
+    from reportlab.platypus.tableofcontents import TableOfContents
 
-    # num_cols = len(col_labels)
+    from pdf_layout import MyDocTemplate
 
-    Directory_Withholding_key = "Directory Withholding-YN"
-    if Directory_Withholding_key not in col_labels:
-        print(f"{Directory_Withholding_key} was not found. not safe to load this")
-        return
+    tmppdf = tempfile.NamedTemporaryFile(suffix=".pdf")
+    doc = MyDocTemplate(tmppdf.name)
+    if owner:
+        doc.owner = owner
+    # only the last pass is saved
+    doc._doSave = 0
 
-    # nuke the preK
+    seeded = entries = load_toc_entries(fingerprint) if use_toc_cache else None
+    for passes in range(max_passes):
+        tocs = []
+        doc._indexingFlowables = []
 
-    num_withheld = 0
+        def add_indexing_flowable(flowable):
+            if not flowable.isIndexing():
+                return
+            if isinstance(flowable, TableOfContents):
+                if entries and len(tocs) < len(entries):
+                    flowable.addEntries(entries[len(tocs)])
+                tocs.append(flowable)
+            flowable.beforeBuild()
+            doc._indexingFlowables.append(flowable)
+
+        try:
+            with layout_profiling():
+                doc.build(FlowableStream(make_stream(), add_indexing_flowable))
+        except LayoutError as e:
+            print(e)
+            print(f"{filename}: laying out the stream failed, making the whole story")
+            return story_to_pdf(
+                list(make_stream()), owner=owner, filename=filename, overflow=overflow
+            )
+        for flowable in doc._indexingFlowables:
+            flowable.afterBuild()
+        if doc._allSatisfied():
+            break
+        entries = toc_entries(tocs)
+    else:
+        print(f"failed to make {filename}, its contents changed on every one of {max_passes} passes")
+        return False
+
+    doc.canv.save()
+    if fingerprint and use_toc_cache and seeded != toc_entries(tocs):
+        save_toc_entries(fingerprint, tocs)
+
+    from shutil import copyfile
+
+    with stage("write"):
+        copyfile(tmppdf.name, filename)
+    return True
+
+
+def split_story(Story):
+    """front matter, and the sections that can be laid out on their own
+
+    a section starts at each TOCHeading1 from the first of section_fields on, and runs to
+    the page break before the next one. the front matter keeps everything before them,
+    the table of contents included
+    """
+    from reportlab.platypus import PageBreak, Paragraph
+
+    starts = []
+    for i, flowable in enumerate(Story):
+        if not (
+            isinstance(flowable, Paragraph) and flowable.style.name == "TOCHeading1"
+        ):
+            continue
+        if starts or flowable.getPlainText() in section_fields:
+            starts.append(i)
+    if not starts:
+        return list(Story), []
+
+    def chunk(start, end):
+        # each section starts a fresh document, so the page break before it goes
+        while end > start and isinstance(Story[end - 1], PageBreak):
+            end -= 1
+        return list(Story[start:end])
+
+    front = chunk(0, starts[0])
+    sections = [chunk(a, b) for a, b in zip(starts, starts[1:] + [len(Story)])]
+    return front, sections
+
+
+# per process state for sections_to_pdf, set once by the pool initializer
+section_worker_state = {}
+
+
+def init_section_worker(sections, profile=None):
+    global profile_stages
+    section_worker_state["sections"] = sections
+    if profile is not None:
+        stage_stats.clear()
+        profile_stages = profile
+
+
+def layout_section(i):
+    """pdf bytes, page count, toc entries and bookmarks of section i laid out on its own"""
+    from pdf_layout import MergeableCanvas, MyDocTemplate, NoPageSetup
+
+    buf = io.BytesIO()
+    doc = MyDocTemplate(buf, onPage=NoPageSetup)
+    with stage("layout"):
+        doc.build(section_worker_state["sections"][i], canvasmaker=MergeableCanvas)
+    return (
+        buf.getvalue(),
+        doc.page,
+        doc.toc_entries,
+        doc.canv.destinations(),
+        take_stage_stats() if profile_stages else {},
+    )
+
+
+@staged("layout")
+def sections_to_pdf(Story, owner=None, filename="mypdf1.pdf", jobs=2):
+    """lay out Story's big sections in jobs processes and merge them, returns True if written
+
+    each section (see split_story) starts a fresh document without page numbers or owner.
+    the front matter is laid out last, its table of contents told where every section's
+    headings ended up (LaterTOCEntries). then the pages are concatenated, page numbers
+    and owner stamped on, the bookmarks behind every internal link gathered into the
+    merged pdf's named destinations, and the outline rebuilt from the table of contents
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from reportlab.platypus.tableofcontents import TableOfContents
+
+    from pdf_layout import LaterTOCEntries, MergeableCanvas, MyDocTemplate
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return False
+    front, sections = split_story(Story)
+    if len(sections) < 2:
+        return False
+
+    tocs = [f for f in front if isinstance(f, TableOfContents)]
+    fingerprint = story_fingerprint(Story) if tocs and use_toc_cache else None
+
+    with ProcessPoolExecutor(
+        max_workers=min(jobs, len(sections)),
+        mp_context=worker_context(),
+        initializer=init_section_worker,
+        initargs=(sections, profile_stages),
+    ) as executor:
+        laid_out = list(executor.map(layout_section, range(len(sections))))
+
+    later_entries = []
+    offset = 0
+    for pdf, pages, entries, destinations, worker_stats in laid_out:
+        merge_stage_stats(worker_stats)
+        for level, text, page, *key in entries:
+            later_entries.append((level, text, offset + page, *key))
+        offset += pages
+
+    buf = io.BytesIO()
+    doc = MyDocTemplate(buf)
+    if owner:
+        doc.owner = owner
+    seeded = seed_tocs(tocs, fingerprint)
+    with layout_profiling():
+        doc.multiBuild(
+            front + [LaterTOCEntries(later_entries)], canvasmaker=MergeableCanvas
+        )
+    if fingerprint and seeded != toc_entries(tocs):
+        save_toc_entries(fingerprint, tocs)
+
+    parts = [(buf.getvalue(), doc.page, doc.canv.destinations())]
+    parts += [(pdf, pages, destinations) for pdf, pages, _, destinations, _ in laid_out]
+    with stage("write"):
+        merge_section_pdfs(parts, doc.toc_entries, owner, filename)
+    return True
+
+
+def merge_section_pdfs(parts, toc_entries, owner, filename):
+    """concatenate [(pdf bytes, pages, destinations)], the first being the front matter
+
+    the pages are copied as they are, page numbers and owner go on in an overlay_pdf update
+    """
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import (
+        ArrayObject,
+        DictionaryObject,
+        FloatObject,
+        NameObject,
+        NullObject,
+        TextStringObject,
+    )
+    from pdf_layout import PageFurniture
+
+    writer = PdfWriter()
+    readers = [PdfReader(io.BytesIO(pdf)) for pdf, _, _ in parts]
+    front_pages = len(readers[0].pages)
+
+    destinations = {}
+    first_page = 0
+    for reader, (_, _, part_destinations) in zip(readers, parts):
+        for page in reader.pages:
+            writer.add_page(page)
+        for name, (page_number, view) in part_destinations.items():
+            destinations[name] = (first_page + page_number - 1, view)
+        first_page += len(reader.pages)
+
+    def number(x):
+        return NullObject() if x in (None, "null") else FloatObject(x)
+
+    names = ArrayObject()
+    for name in sorted(destinations):
+        page_index, (kind, *args) = destinations[name]
+        names.append(TextStringObject(name))
+        names.append(
+            ArrayObject(
+                [writer.pages[page_index].indirect_reference, NameObject(kind)]
+                + [number(x) for x in args]
+            )
+        )
+    dests = DictionaryObject({NameObject("/Names"): names})
+    writer._root_object[NameObject("/Names")] = DictionaryObject(
+        {NameObject("/Dests"): writer._add_object(dests)}
+    )
+
+    parents = {}
+    for level, text, page, *key in toc_entries:
+        parents[level] = writer.add_outline_item(
+            text, page - 1, parent=parents.get(level - 1)
+        )
+
+    metadata = dict(readers[0].metadata or {})
+    if owner:
+        metadata["/Subject"] = owner
+    writer.add_metadata(metadata)
+
+    tmp_path = f"{filename}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as outfh:
+        writer.write(outfh)
+    # page numbers and owner for the pages laid out without them, the way stamp_pdf adds an owner
+    overlay_pdf(
+        tmp_path,
+        lambda canvas, page_num: PageFurniture(canvas, page_num, owner),
+        first_page=front_pages + 1,
+    )
+    os.replace(tmp_path, filename)
+
+
+# remember the finished table of contents of each story, see seed_tocs
+use_toc_cache = True
+
+
+def story_fingerprint(Story, code=None):
+    """sha1 of everything in Story that can move a heading to another page or change how a
+    page looks, and of code, layout_code_sha256() unless given. Story can be a stream"""
+    from reportlab.platypus import Flowable, Paragraph, Table
+
+    from pdf_layout import QRCode, StudentRecord
+
+    digest = hashlib.sha1((code or layout_code_sha256()).encode("utf-8"))
+
+    def feed(*parts):
+        for part in parts:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\0")
+
+    for flowable in Story:
+        todo = [flowable]
+        while todo:
+            f = todo.pop()
+            if isinstance(f, (list, tuple)):
+                todo.extend(f)
+            elif isinstance(f, Paragraph):
+                feed("P", f.style.name, f.text)
+            elif isinstance(f, Table):
+                feed("T", len(f._cellvalues), f._colWidths, f._linecmds, f._bkgrndcmds)
+                todo.extend(f._cellvalues)
+            elif isinstance(f, QRCode):
+                feed("Q", f.url, f.size)
+            elif isinstance(f, StudentRecord):
+                feed("S", f.rows)
+                todo.extend(f._content)
+            elif isinstance(f, Flowable):
+                feed(f.__class__.__name__, getattr(f, "width", ""), getattr(f, "height", ""))
+                todo.extend(getattr(f, "_content", None) or [])
+            else:
+                feed(f)
+    return digest.hexdigest()
+
+
+def toc_cache_path(fingerprint):
+    return pathlib.Path(cache_dir) / "toc" / f"{fingerprint}.pickle"
+
+
+def seed_tocs(tocs, fingerprint):
+    """fill tocs with the entries an identical story ended up with last time
+
+    multiBuild lays the document out again until its table of contents stops changing.
+    seeded with the final entries, the first pass already matches and is the only one.
+    a stale seed just costs the extra passes an unseeded build would have taken.
+    returns the entries used, or None
+    """
+    entries = load_toc_entries(fingerprint)
+    if entries is None or len(entries) != len(tocs):
+        return None
+    for toc, entries_for_toc in zip(tocs, entries):
+        toc.clearEntries()
+        toc.addEntries(entries_for_toc)
+    return entries
+
+
+def load_toc_entries(fingerprint):
+    """the entries of each table of contents saved under fingerprint, or None"""
+    if not fingerprint:
+        return None
+    path = toc_cache_path(fingerprint)
+    if not path.is_file():
+        return None
+    with open(path, "rb") as fh:
+        return pickle.load(fh)
+
+
+def toc_entries(tocs):
+    return [list(toc._entries) for toc in tocs]
+
+
+def save_toc_entries(fingerprint, tocs):
+    path = toc_cache_path(fingerprint)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_path, "wb") as fh:
+        pickle.dump(toc_entries(tocs), fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def layout_probe(flowable):
+    """True if flowable lays out on its own, in a directory sized frame"""
+    from reportlab.lib.units import inch
+    from reportlab.platypus.doctemplate import (
+        BaseDocTemplate,
+        LayoutError,
+        PageTemplate,
+    )
+
+    from pdf_layout import directory_frame
+
+    doc = BaseDocTemplate(io.BytesIO(), pagesize=(5.5 * inch, 8.5 * inch))
+    doc.addPageTemplates(PageTemplate("probe", [directory_frame()]))
+    try:
+        doc.build([flowable])
+    except LayoutError:
+        return False
+    return True
+
+
+def describe_flowable(flowable):
+    """the student name, heading or other first text in flowable, for error reports"""
+    from reportlab.platypus import Paragraph
+
+    todo = [flowable]
+    while todo:
+        f = todo.pop(0)
+        if isinstance(f, Paragraph):
+            return repr(f.getPlainText()[:60])
+        todo.extend(getattr(f, "_content", None) or [])
+    return flowable.__class__.__name__
+
+
+def find_overflowing_flowables(Story):
+    """[(position, section, description)] for each top level flowable that can't be laid out alone
+
+    anything that wraps within the frame is fine, only the rest pay for a trial layout
+    """
+    from reportlab.platypus import PageBreak, Paragraph
+    from reportlab.platypus.tableofcontents import TableOfContents
+
+    from pdf_layout import directory_frame
+
+    frame = directory_frame()
+    aW = frame._width - frame._leftPadding - frame._rightPadding
+    aH = frame._height - frame._topPadding - frame._bottomPadding
+
+    out = []
+    section = None
+    for i, flowable in enumerate(Story):
+        if isinstance(flowable, Paragraph) and flowable.style.name == "TOCHeading1":
+            section = flowable.getPlainText()
+        if isinstance(flowable, (PageBreak, TableOfContents)):
+            continue
+        try:
+            w, h = flowable.wrap(aW, aH)
+            if w <= aW and h <= aH:
+                continue
+        except Exception:
+            pass
+        if not layout_probe(flowable):
+            out.append((i, section, describe_flowable(flowable)))
+    return out
+
+
+def fit_overflowing_flowables(Story, overflowing, overflow):
+    from xml.sax.saxutils import escape
+
+    from reportlab.platypus import Paragraph
+    from reportlab.platypus.flowables import KeepInFrame, KeepTogether
+
+    from pdf_layout import directory_frame, directory_styles
+
+    frame = directory_frame()
+    aW = frame._width - frame._leftPadding - frame._rightPadding
+    aH = frame._height - frame._topPadding - frame._bottomPadding
+
+    Story = list(Story)
+    for i, section, description in overflowing:
+        if overflow == "shrink":
+            content = Story[i]
+            content = content._content if isinstance(content, KeepTogether) else [content]
+            Story[i] = KeepInFrame(aW, aH, content, mode="shrink")
+        else:
+            # description comes from the roster, and a Paragraph reads markup
+            Story[i] = Paragraph(
+                f"{escape(description)} was too large to include here",
+                directory_styles().normal,
+            )
+    return Story
+
+
+@staged("write")
+def stamp_pdf(base_pdf, owner, filename):
+    """personalize an already built, ownerless directory by overlaying the owner on each page
+
+    produces the same pages as story_to_pdf(..., owner=owner) without redoing the layout.
+    filename is base_pdf byte for byte, plus the incremental update of overlay_pdf
+    """
+    from pdf_layout import OwnerStamp
+
+    shutil.copyfile(base_pdf, filename)
+    overlay_pdf(
+        filename,
+        lambda canvas, page_num: OwnerStamp(canvas, page_num, owner),
+        subject=owner,
+    )
+
+
+def overlay_pdf(filename, draw, first_page=2, subject=None):
+    """draw(canvas, page_num) onto every page of filename from first_page on, in place
+
+    appends an incremental update that gives each page a form XObject with what draw drew
+    and a content stream drawing it. only the page dictionaries are read, the content and
+    everything else already in filename is never parsed or rewritten. with subject, the
+    document info gets it as /Subject
+    """
+    from PyPDF2 import PdfReader
+    from PyPDF2.generic import (
+        ArrayObject,
+        DecodedStreamObject,
+        DictionaryObject,
+        IndirectObject,
+        NameObject,
+        NumberObject,
+        StreamObject,
+        TextStringObject,
+    )
+    from reportlab.lib.units import inch
+    from reportlab.pdfgen.canvas import Canvas
+
+    reader = PdfReader(filename)
+
+    overlay_buf = io.BytesIO()
+    overlay_canvas = Canvas(overlay_buf, pagesize=(5.5 * inch, 8.5 * inch))
+    for page_num in range(1, len(reader.pages) + 1):
+        if page_num >= first_page:
+            draw(overlay_canvas, page_num)
+        overlay_canvas.showPage()
+    overlay_canvas.save()
+    overlay = PdfReader(overlay_buf)
+
+    # object number -> object, for everything the update adds or replaces
+    updated = {}
+    size = reader.trailer["/Size"]
+
+    def add(obj):
+        nonlocal size
+        updated[size] = obj
+        size += 1
+        return IndirectObject(size - 1, 0, reader)
+
+    adopted = {}
+
+    def adopt(obj):
+        """obj from the overlay, with whatever it refers to added to the update"""
+        if isinstance(obj, IndirectObject):
+            if obj.idnum not in adopted:
+                adopted[obj.idnum] = add(None)
+                updated[adopted[obj.idnum].idnum] = adopt(obj.get_object())
+            return adopted[obj.idnum]
+        if isinstance(obj, StreamObject):
+            copied = DecodedStreamObject()
+            copied.set_data(obj.get_data())
+            copied.update({k: adopt(v) for k, v in obj.items() if k not in ("/Length", "/Filter")})
+            return copied
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({k: adopt(v) for k, v in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(adopt(v) for v in obj)
+        return obj
+
+    def stream(data, **entries):
+        obj = DecodedStreamObject()
+        obj.set_data(data)
+        obj.update({NameObject(k): v for k, v in entries.items()})
+        return add(obj)
+
+    # the base page's content runs inside q .. Q, so whatever state it leaves can't move the stamp
+    save_state = stream(b"q\n")
+
+    for page_num, (page, overlay_page) in enumerate(zip(reader.pages, overlay.pages), 1):
+        if page_num < first_page:
+            continue
+        name = NameObject(f"/Overlay{page_num}")
+        stamp = stream(
+            overlay_page.get_contents().get_data(),
+            **{
+                "/Type": NameObject("/XObject"),
+                "/Subtype": NameObject("/Form"),
+                "/BBox": overlay_page.mediabox,
+                "/Resources": adopt(overlay_page.raw_get("/Resources")),
+            },
+        )
+
+        resources = page.raw_get("/Resources")
+        if isinstance(resources, IndirectObject):
+            # shared with other pages, the whole object is rewritten
+            ref, resources = resources, resources.get_object()
+            updated[ref.idnum] = resources
+        xobjects = resources.raw_get("/XObject") if "/XObject" in resources else None
+        if isinstance(xobjects, IndirectObject):
+            ref, xobjects = xobjects, xobjects.get_object()
+            updated[ref.idnum] = xobjects
+        elif xobjects is None:
+            xobjects = resources[NameObject("/XObject")] = DictionaryObject()
+        xobjects[name] = stamp
+
+        contents = page.raw_get("/Contents")
+        if isinstance(contents.get_object(), ArrayObject):
+            contents = list(contents.get_object())
+        else:
+            contents = [contents]
+        do = stream(f"Q\nq {name} Do Q\n".encode("ascii"))
+        page[NameObject("/Contents")] = ArrayObject([save_state, *contents, do])
+        updated[page.indirect_reference.idnum] = page
+
+    trailer = DictionaryObject({NameObject("/Root"): reader.trailer.raw_get("/Root")})
+    if subject:
+        info = DictionaryObject(reader.trailer["/Info"].get_object())
+        info[NameObject("/Subject")] = TextStringObject(subject)
+        trailer[NameObject("/Info")] = add(info)
+    elif "/Info" in reader.trailer:
+        trailer[NameObject("/Info")] = reader.trailer.raw_get("/Info")
+    if "/ID" in reader.trailer:
+        trailer[NameObject("/ID")] = reader.trailer["/ID"]
+
+    with open(filename, "r+b") as outfh:
+        base = outfh.read()
+        start = base.rindex(b"startxref")
+        trailer[NameObject("/Prev")] = NumberObject(int(base[start + 9 :].split()[0]))
+        trailer[NameObject("/Size")] = NumberObject(size)
+        write_incremental_update(outfh, updated, trailer)
+
+
+def write_incremental_update(fh, objects, trailer):
+    """append objects ({number: object}) and an xref section for them to the pdf open in fh"""
+    fh.seek(0, os.SEEK_END)
+    fh.write(b"\n")
+    offsets = {}
+    for num, obj in sorted(objects.items()):
+        offsets[num] = fh.tell()
+        fh.write(f"{num} 0 obj\n".encode("ascii"))
+        obj.write_to_stream(fh, None)
+        fh.write(b"\nendobj\n")
+    xref = fh.tell()
+    fh.write(b"xref\n")
+    for num, offset in offsets.items():
+        fh.write(f"{num} 1\n{offset:010d} 00000 n \n".encode("ascii"))
+    fh.write(b"trailer\n")
+    trailer.write_to_stream(fh, None)
+    fh.write(f"\nstartxref\n{xref}\n%%EOF\n".encode("ascii"))
+
+
+# which directory sections show each per student field, see affected_sections
+section_fields = {
+    "Full Details by Last Name": None,  # everything
+    "By Grade & Teacher": {"Student", "Grade", "Homeroom Teacher"},
+    "By First Name": {"Student"},
+    "By Street": {"Student", "Address1"},
+}
+
+
+def directory_snapshot(index):
+    """what a directory built from index depends on: the layout_modules and every student"""
+    return {
+        "code": layout_code_sha256(),
+        "students": index.students,
+    }
+
+
+def directory_fingerprint(index):
+    """sha1 of directory_snapshot(index), keys the TOC cache when there's no whole story to hash"""
+    snapshot = pickle.dumps(directory_snapshot(index), protocol=pickle.HIGHEST_PROTOCOL)
+    return hashlib.sha1(snapshot).hexdigest()
+
+
+@staged("story")
+def directory_version(pool, index=None):
+    """what a family's copy of the directory of pool is made from, the recipient ledger's version
+
+    story_fingerprint of the story, streamed, with pdf_layout.py for the code that draws it.
+    unlike the built pdf's bytes, it is the same however the layout was parallelized or
+    streamed. an edit to make_directory.py that leaves the story alone keeps it
+    """
+    return story_fingerprint(
+        pool_to_story_stream(pool, index=index), code=modules_sha256(("pdf_layout.py",))
+    )
+
+
+def directory_snapshot_path(filename):
+    return pathlib.Path(cache_dir) / "directory" / f"{make_filename_safe(filename)}.pickle"
+
+
+@staged("write")
+def save_directory_snapshot(filename, snapshot):
+    path = directory_snapshot_path(filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as fh:
+        pickle.dump(snapshot, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def diff_directory_snapshots(old, new):
+    """added and removed student_uids, and changed {student_uid: {field, ...}}"""
+    old_students = old["students"]
+    new_students = new["students"]
+    added = [uid for uid in new_students if uid not in old_students]
+    removed = [uid for uid in old_students if uid not in new_students]
+    changed = {}
+    for uid, student in new_students.items():
+        old_student = old_students.get(uid)
+        if old_student is None or old_student == student:
+            continue
+        changed[uid] = {
+            k
+            for k in set(student) | set(old_student)
+            if student.get(k) != old_student.get(k)
+        }
+    return added, removed, changed
+
+
+def affected_sections(added, removed, changed):
+    out = []
+    for section, fields in section_fields.items():
+        if added or removed:
+            out.append(section)
+        elif fields is None:
+            if changed:
+                out.append(section)
+        elif any(fields & changed_fields for changed_fields in changed.values()):
+            out.append(section)
+    return out
+
+
+def directory_changes(filename, snapshot):
+    """compares snapshot with the one saved when filename was last built, and reports the differences
+
+    returns the names of the sections the changes show up in, or [] when filename is still current.
+    they all share one layout (page numbers, TOC, links) so any change still rebuilds the whole pdf
+    """
+    path = directory_snapshot_path(filename)
+    if not pathlib.Path(filename).is_file() or not path.is_file():
+        print(f"no previous build of {filename}, building everything")
+        return list(section_fields)
+
+    with open(path, "rb") as fh:
+        old = pickle.load(fh)
+    if old.get("code") != snapshot["code"]:
+        print(f"the layout code changed since {filename} was made, building everything")
+        return list(section_fields)
+
+    added, removed, changed = diff_directory_snapshots(old, snapshot)
+    for uid in added:
+        print(f"added   {snapshot['students'][uid]['Student']}")
+    for uid in removed:
+        print(f"removed {old['students'][uid]['Student']}")
+    for uid, fields in changed.items():
+        print(f"changed {snapshot['students'][uid]['Student']}: {', '.join(sorted(fields))}")
+    print(f"{len(added)} added, {len(removed)} removed, {len(changed)} changed")
+
+    sections = affected_sections(added, removed, changed)
+    for section in sections:
+        print(f"  affects {section}")
+    return sections
+
+
+withheld_marker = "(withheld)"
+
+
+@contextlib.contextmanager
+def open_xlsx(src):
+    """the active sheet of src, opened read-only so rows are streamed rather than loaded
+
+    a read-only workbook keeps its file open until closed, which leaving the with does
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(filename=src, read_only=True)
+    try:
+        yield wb.active
+    finally:
+        wb.close()
+
+
+def sheet_rows(sheet):
+    """yields the header, then every data row, as tuples of values padded to the header width
+
+    sheet is an openpyxl worksheet (see open_xlsx) or a gspread worksheet.
+    each call streams the sheet again, so one opened sheet can feed
+    xlsx_to_pool, xlsx_to_dict and xlsx_to_emails
+    """
+    if hasattr(sheet, "iter_rows"):
+        rows = sheet.iter_rows(values_only=True)
+    else:
+        rows = iter(sheet.get_all_values())
+
+    header = tuple(next(rows))
+    while header and header[-1] is None:
+        header = header[:-1]
+    yield header
+
+    width = len(header)
+    padding = (None,) * width
+    for row in rows:
+        row = tuple(row)
+        if len(row) < width:
+            row += padding[len(row) :]
+        yield row[:width]
+
+
+cache_dir = os.environ.get("PTA_CACHE_DIR", ".pta_cache")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# the modules whose code decides what a directory looks like
+layout_modules = ("make_directory.py", "pdf_layout.py", "addresses.py")
+# the modules whose code decides what a roster parses to, withholding and all
+roster_modules = ("make_directory.py", "addresses.py")
+
+
+@functools.lru_cache(maxsize=None)
+def modules_sha256(names):
+    """sha256 over the source of the modules names, beside this file"""
+    here = pathlib.Path(__file__).resolve().parent
+    digest = hashlib.sha256()
+    for name in names:
+        digest.update(f"{name} {file_sha256(here / name)}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def layout_code_sha256():
+    """changes with any edit to layout_modules, so an edit to any of them rebuilds"""
+    return modules_sha256(layout_modules)
+
+
+def roster_code_sha256():
+    """changes with any edit to roster_modules, so a parse by other code is never reused"""
+    return modules_sha256(roster_modules)
+
+
+def roster_cache_dir():
+    return pathlib.Path(cache_dir) / "roster"
+
+
+def roster_cache_path(loader, src, digest=None):
+    """where cached_roster keeps loader(src), whether or not it is there yet"""
+    digest = digest or file_sha256(src)
+    code = roster_code_sha256()
+    return roster_cache_dir() / f"{digest}-{loader.__name__}-{code[:16]}.pickle"
+
+
+def cached_roster(loader, src, sheet=None, use_cache=True):
+    """loader(src) as parsed by an earlier run on an identical src, or parse it now and remember
+
+    entries are keyed on the content hash of src, the loader and roster_code_sha256(), so a
+    change to the parsing or withholding code always parses again. sheet is src already
+    opened (see open_xlsx), shared by every loader that has to parse it.
+    each file holds a small pickled header (see roster-cache) followed by the pickled result
+    """
+    if not src or not use_cache:
+        return loader(src, sheet=sheet)
+
+    digest = file_sha256(src)
+    code = roster_code_sha256()
+    path = roster_cache_path(loader, src, digest)
+    if path.is_file():
+        with open(path, "rb") as fh:
+            header = pickle.load(fh)
+            result = pickle.load(fh)
+        if header.get("rows_as") == "RosterRow":
+            result = [RosterRow(x.keys(), x.values()) for x in result]
+        print(f"loaded {loader.__name__}({src}) from {path}")
+        return result
+
+    result = loader(src, sheet=sheet)
+    if isinstance(result, types.GeneratorType):
+        result = list(result)
+    if result is None:
+        return None
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    header = {
+        "src": str(src),
+        "sha256": digest,
+        "loader": loader.__name__,
+        "code": code,
+        "rows": len(result),
+    }
+    stored = result
+    if isinstance(result, list) and result and isinstance(result[0], RosterRow):
+        # plain dicts, so the cache doesn't depend on how this module was imported
+        header["rows_as"] = "RosterRow"
+        stored = [x.as_dict() for x in result]
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_path, "wb") as fh:
+        pickle.dump(header, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(stored, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return result
+
+
+class RosterRow:
+    """one row of the MCPS export
+
+    stores the known columns in fixed slots, with repeated values (teacher, grade,
+    street, city, ...) interned, rather than a per row dict of strings. reads like
+    the dict it replaces via get() and [] so pool consumers need no changes.
+    columns we don't know about are kept in extra.
+    """
+
+    # column label -> slot
+    fields = {
+        "Sch Num": "sch_num",
+        "School": "school",
+        "Student": "student",
+        "Student ID": "student_id",
+        "Birth Date": "birth_date",
+        "Grade": "grade",
+        "Homeroom Teacher": "homeroom_teacher",
+        "Directory Withholding-YN": "directory_withholding",
+        "Phone": "phone",
+        "Home Address1": "home_address1",
+        "Home Address2": "home_address2",
+        "Mailing Address1": "mailing_address1",
+        "Mailing Address2": "mailing_address2",
+        "Address1": "address1",
+        "Address2": "address2",
+        "Relation": "relation",
+        "Parent/Guardian Name": "parent_guardian_name",
+        "Name": "name",
+        "Parent/Guardian Cell Phone": "parent_guardian_cell_phone",
+        "Cell Phone": "cell_phone",
+        "Parent/Guardian Email": "parent_guardian_email",
+        "Email": "email",
+    }
+    __slots__ = (*fields.values(), "extra")
+
+    def __init__(self, labels, values):
+        for slot in self.fields.values():
+            setattr(self, slot, None)
+        self.extra = None
+        for label, value in zip(labels, values):
+            if value is not None:
+                value = sys.intern(value)
+            slot = self.fields.get(label)
+            if slot:
+                setattr(self, slot, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[label] = value
+
+    def get(self, key, default=None):
+        slot = self.fields.get(key)
+        if slot:
+            value = getattr(self, slot)
+        elif self.extra:
+            value = self.extra.get(key)
+        else:
+            value = None
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def as_dict(self):
+        out = {}
+        for label, slot in self.fields.items():
+            value = getattr(self, slot)
+            if value is not None:
+                out[label] = value
+        if self.extra:
+            out.update(self.extra)
+        return out
+
+    def __getstate__(self):
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state.keys(), state.values())
+
+    def __eq__(self, other):
+        if isinstance(other, RosterRow):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+def xlsx_to_pool(src, sheet=None):
+    if sheet is None:
+        with open_xlsx(src) as sheet:
+            return xlsx_to_pool(src, sheet=sheet)
+
+    rows = sheet_rows(sheet)
+
+    # col_labels = sheet.row_values(1)
+    col_labels = next(rows)
+
+    col_clean_labels = [x.strip() for x in col_labels]
+    clean_col = {x: y for x, y in zip(col_labels, col_clean_labels)}
+    labels = [clean_col[x] for x in clean_col]
+
+    # num_cols = len(col_labels)
+
+    Directory_Withholding_key = "Directory Withholding-YN"
+    if Directory_Withholding_key not in col_labels:
+        print(f"{Directory_Withholding_key} was not found. not safe to load this")
+        return
+
+    # nuke the preK
+
+    num_withheld = 0
     num_accepted = 0
     pool = []
 
     emails_with_includes = {}
     emails_with_excludes = {}
 
-    for araw in sheet.rows:
+    for araw in rows:
 
-        raw_dict = {}
-        for label, acell in zip(clean_col, araw):
-            raw_dict[label] = str(acell.value)
-
-        adict = {clean_col[x]: str(y) for x, y in raw_dict.items()}
+        adict = RosterRow(labels, map(str, araw))
         withheld = False
 
-        delkeys = []
-        for k in adict.keys():
-            if adict[k] is None:
-                delkeys.append(k)
-        for k in delkeys:
-            del adict[k]
         Directory_Withholding = adict.get(Directory_Withholding_key)
 
         if Directory_Withholding != "N":
@@ -2688,24 +4256,19 @@ def filter_pool_to_students(pool, students):
     return out_pool
 
 
-def xlsx_to_emails(src):
+def xlsx_to_emails(src, sheet=None):
     """does not respect witholding, does not need to as currently used"""
-    from openpyxl import load_workbook
+    if sheet is None:
+        with open_xlsx(src) as sheet:
+            return xlsx_to_emails(src, sheet=sheet)
 
-    wb = load_workbook(filename=src)
-    sheet = wb.active
+    rows = sheet_rows(sheet)
 
     col_labels = []
-    for row in sheet.iter_rows(min_row=0, min_col=0, max_row=1, max_col=4000):
-        for cell in row:
-            # print(cell.row, cell.column, cell.value)
-            val = cell.value
-            if val:
-                val = val.strip()
-            col_labels.append(val)
-    while col_labels[-1] is None:
-        col_labels.pop()
-    num_cols = len(col_labels)
+    for val in next(rows):
+        if val:
+            val = val.strip()
+        col_labels.append(val)
 
     # num_withheld = 0
     # num_accepted = 0
@@ -2720,13 +4283,8 @@ def xlsx_to_emails(src):
         ]
     )
     emails = {}
-    for row in sheet.iter_rows(
-        min_row=2,
-        min_col=0,
-        # max_row=6,
-        max_col=num_cols,
-    ):
-        adict = dict(zip(col_labels, [x.value for x in row]))
+    for row in rows:
+        adict = dict(zip(col_labels, row))
         email = get_relation_email(adict)
         if email:
             email = email.lower()
@@ -2745,6 +4303,7 @@ def format_phone(phone):
     return phone
 
 
+@functools.lru_cache(maxsize=identifier_cache_size)
 def street_url(street_name):
     if street_name:
         return "street_" + hashlib.sha1(street_name.encode("utf-8")).hexdigest()
@@ -2760,10 +4319,9 @@ def format_address(student):
     street_name = get_street(address1)
     url = street_url(street_name)
 
-    link = f"<link href='#{url}'>{street_name}</link>"
-    pretty_address1 = re.sub(street_name, link, address1)
-
     if address1 and address2:
+        link = f"<link href='#{url}'>{street_name}</link>"
+        pretty_address1 = address1.replace(street_name, link)
         address = f"{pretty_address1}<br/>{address2}"
     else:
         address = f"{student.get('Address1','')}<br/>{student.get('Address2','')}"
@@ -3020,18 +4578,18 @@ staff_order = [
 
 def xlsx_to_dict(src, sheet=None):
     if sheet is None:
-        from openpyxl import load_workbook
+        with open_xlsx(src) as sheet:
+            yield from xlsx_to_dict(src, sheet=sheet)
+        return
 
-        wb = load_workbook(filename=src)
-        sheet = wb.active
-    else:
-        pass
+    rows = sheet_rows(sheet)
 
     # col_labels = sheet.row_values(1)
-    col_labels = [x.value for x in next(sheet.rows)]
+    col_labels = next(rows)
 
     col_clean_labels = [x.strip() for x in col_labels]
     clean_col = {x: y for x, y in zip(col_labels, col_clean_labels)}
+    labels = [clean_col[x] for x in clean_col]
 
     # num_cols = len(col_labels)
 
@@ -3048,21 +4606,11 @@ def xlsx_to_dict(src, sheet=None):
     # emails_with_includes = {}
     # emails_with_excludes = {}
 
-    for araw in sheet.rows:
+    for araw in rows:
 
-        raw_dict = {}
-        for label, acell in zip(clean_col, araw):
-            raw_dict[label] = str(acell.value)
-
-        adict = {clean_col[x]: str(y) for x, y in raw_dict.items()}
+        adict = RosterRow(labels, map(str, araw))
         withheld = False
 
-        delkeys = []
-        for k in adict.keys():
-            if adict[k] is None:
-                delkeys.append(k)
-        for k in delkeys:
-            del adict[k]
         Directory_Withholding = adict.get(Directory_Withholding_key)
 
         if Directory_Withholding != "N":
@@ -3101,10 +4649,115 @@ def xlsx_to_dict(src, sheet=None):
             num_withheld += 1
 
 
+@cli.command("roster-cache")
+@click.option("--src", help="only show entries for this MCPS export .xlsx", required=False)
+@click.option(
+    "--evict",
+    multiple=True,
+    help="remove entries whose name starts with this, may be repeated",
+)
+@click.option(
+    "--evict-all/-no-evict-all", default=False, help="remove every listed entry"
+)
+@click.pass_context
+def roster_cache(ctx, src=None, evict=(), evict_all=False):
+    """list or remove the parsed rosters remembered by --cache"""
+
+    digest = file_sha256(src) if src else None
+
+    total = 0
+    for path in sorted(roster_cache_dir().glob("*.pickle")):
+        if digest and not path.name.startswith(digest):
+            continue
+        try:
+            with open(path, "rb") as fh:
+                header = pickle.load(fh)
+        except Exception as e:
+            header = {"error": str(e)}
+
+        size = path.stat().st_size
+        stale = header.get("code") != roster_code_sha256()
+        if evict_all or any(path.name.startswith(x) for x in evict):
+            path.unlink()
+            print(f"evicted {path.name}")
+            continue
+
+        total += size
+        print(
+            f"{path.name}\t{size:,d} bytes\t{header.get('rows')} rows\t{header.get('src')}"
+            + ("\tSTALE" if stale else "")
+        )
+    print(f"{total:,d} bytes in {roster_cache_dir()}")
+
+
+@cli.command("mail-status")
+@click.option(
+    "--all-versions/-no-all-versions",
+    default=False,
+    help="every version mailed, not just the latest",
+)
+@click.pass_context
+def mail_status(ctx, all_versions=False):
+    """show who has been sent which version of the directory, and what is left to retry"""
+    with open_mail_ledger() as ledger:
+        versions = ledger.versions()
+        for version in versions if all_versions else versions[:1]:
+            print_mail_progress(ledger, version, verbose=True)
+
+
+@cli.command("post-memberhub-events")
+@click.option("--calendar", help="events .csv or .yaml, see memberhub.read_calendar", required=True)
+@click.option(
+    "--organization",
+    default="5e3494f2-db0d-4f81-a25a-8058e4abced5",
+    help="MemberHub organization uuid the events belong to",
+)
+@click.option("--jobs", default=4, type=int, help="number of requests in flight at once")
+@click.option(
+    "--dry-run/-no-dry-run", default=False, help="print the events instead of posting them"
+)
+@click.pass_context
+def post_memberhub_events(ctx, calendar, organization, jobs=4, dry_run=False):
+    """create a MemberHub calendar event for every row of --calendar
+
+    the session comes from MEMBERHUB_SESSION_TOKEN and MEMBERHUB_SESSION_SECRET, the
+    MemberHub-Session-* headers of a logged in browser, and MEMBERHUB_API_URL can point
+    at a stand-in
+    """
+    import asyncio
+    import json
+
+    import memberhub
+
+    rows = memberhub.read_calendar(calendar)
+    if dry_run:
+        for row in rows:
+            print(json.dumps(memberhub.calendar_event(row, organization), indent=2))
+        return
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    async def post():
+        async with memberhub.MemberHubClient(
+            os.environ["MEMBERHUB_SESSION_TOKEN"],
+            os.environ["MEMBERHUB_SESSION_SECRET"],
+            concurrency=jobs,
+        ) as client:
+            return await memberhub.post_calendar(client, organization, rows)
+
+    if asyncio.run(post()):
+        ctx.exit(1)
+
+
 @cli.command("make-memberhub-import")
 @click.option("--src", help="MCPS export .xlsx", required=True)
+@click.option(
+    "--cache/-no-cache", default=True, help="reuse the parsed --src from the roster cache"
+)
 @click.pass_context
-def make_memberhub_import(ctx, src):
+def make_memberhub_import(ctx, src, cache=True):
     """setup whatever is needed"""
 
     extra_org_roles = {
@@ -3128,17 +4781,19 @@ def make_memberhub_import(ctx, src):
 
     errors = False
     fam = {}
-    next_fam_id = 123
-    seen_fam = {}
     # seen_fam_name = {}
     # seen_fam_name_rev = {}
 
     grade_teachers = {}
 
-    for adict in xlsx_to_dict(src):
+    with stage("load"):
+        rows = list(cached_roster(xlsx_to_dict, src, use_cache=cache))
+    index = DirectoryIndex(rows)
+
+    for adict in rows:
         # print(adict)
 
-        if True:
+        with stage("normalize"):
             fam_id = None
             row = adict
 
@@ -3154,19 +4809,12 @@ def make_memberhub_import(ctx, src):
             relation_cell = get_relation_phone(row)
             relation_email = get_relation_email(row)
 
-            fam_val = address1
+            fam_val = index.family_key(row)
             if not fam_val.strip():
-                fam_val = relation_cell
-                if not fam_val.strip():
-                    print(f"no family figured out for {fam_val.rstrip()}")
-                    breakpoint()
+                print(f"no family figured out for {fam_val.rstrip()}")
+                breakpoint()
 
-            if fam_val in seen_fam:
-                fam_id = seen_fam[fam_val]
-            else:
-                fam_id = f"fam{next_fam_id}"
-                next_fam_id += 1
-                seen_fam[fam_val] = fam_id
+            fam_id = index.family_id(row)
 
             # fam_id2fam_name(fam_id, fam_val, name=student_lastname)
 
@@ -3315,13 +4963,10 @@ def make_memberhub_import(ctx, src):
 
                     acontact["Address"] = aparent["address1"]
 
-                    if m := re.search(r"([\w\s+]+), (\w\w) (\d+)", aparent["address2"]):
-
-                        city, state, zipcode = m.groups()
-                        city = city.strip()
-                    acontact["City"] = city
-                    acontact["State"] = state
-                    acontact["Zip"] = zipcode
+                    address = parse_address(aparent["address1"], aparent["address2"])
+                    acontact["City"] = address.city
+                    acontact["State"] = address.state
+                    acontact["Zip"] = address.zip
 
                     acontact["Family Name"] = normalize(afam_name, fam_id)
                     acontact["Family Role"] = "Parent/Guardian"
@@ -3371,15 +5016,12 @@ def make_memberhub_import(ctx, src):
 
                     acontact["Address"] = astudent["address1"]
 
-                    if m := re.search(
-                        r"([\w\s+]+), (\w\w) (\d+)", astudent["address2"]
-                    ):
-
-                        city, state, zipcode = m.groups()
-                        city = city.strip()
-                    acontact["City"] = city
-                    acontact["State"] = state
-                    acontact["Zip"] = zipcode
+                    address = parse_address(
+                        astudent["address1"], astudent["address2"]
+                    )
+                    acontact["City"] = address.city
+                    acontact["State"] = address.state
+                    acontact["Zip"] = address.zip
                     # acontact["Family Name"] = str(fam_id)
                     acontact["Family Name"] = normalize(afam_name, fam_id)
 
@@ -3437,7 +5079,7 @@ def make_memberhub_import(ctx, src):
                     else:
                         seen_emails.add(contact.get("Email"))
 
-            with open("ready_to_load.csv", "w") as outfh:
+            with stage("write"), open("ready_to_load.csv", "w") as outfh:
                 outfh.write(",".join(contact_keys))
                 outfh.write("\n")
                 for contact in contacts:
@@ -3549,6 +5191,10 @@ def normalize(name, fam_id):
 
 
 def as_email(username, recipients, attachment):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    from delivery import StreamedAttachment
 
     sender_email = username
 
@@ -3564,36 +5210,32 @@ def as_email(username, recipients, attachment):
     message.attach(body)
 
     if attachment:
-        with open(attachment, "rb") as attachment_fh:
-            part = MIMEBase("application", "pdf")
-            part.set_payload(attachment_fh.read())
-        encoders.encode_base64(part)
+        # encoded from the file while it is sent, see delivery.StreamedAttachment
         attachment_name = pathlib.Path(attachment).name
-        part.add_header(
-            "Content-Disposition",
-            f'attachment; filename="{attachment_name}"',
+        message.attach(
+            StreamedAttachment(attachment, "application", "pdf", attachment_name)
         )
-        message.attach(part)
 
     # print(f"{len(message.as_string()):,d} bytes")
 
     yield message
 
 
-def send_emails(username, password, messages):
+# where mail goes, PTA_SMTP_HOST=localhost PTA_SMTP_PORT=1025 for a local stand-in
+smtp_host = os.environ.get("PTA_SMTP_HOST", "smtp.gmail.com")
+smtp_port = int(os.environ.get("PTA_SMTP_PORT", "465"))
 
-    sender_email = username
-    sender_password = password
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        a1 = server.login(sender_email, sender_password)
-        print(a1)
-        # a2 = server.sendmail(sender_email, recipient, message.as_string())
-        # 1) You should use msg.as_string() if you call smtplib.SMTP.sendmail(). Alternatively, if you have Python 3.2 or newer, you can use
+def send_emails(username, password, messages):
+    """send messages over one connection, returns {To: error} for those that failed"""
+    from delivery import DeliveryEngine
+
+    with DeliveryEngine(
+        username, password, host=smtp_host, port=smtp_port, connections=1
+    ) as engine:
         for message in messages:
-            # print(message.as_string())
-            a2 = server.send_message(message)
-            print(a2)
+            engine.submit(None, message)
+    return engine.failures
 
 
 @cli.command("send-test-directory-email")
@@ -3612,7 +5254,395 @@ def send_test_directory_email(ctx):
         recipients=recipients,
         # attachment=filename,
     )
-    send_emails(username=login_username, password=password, messages=stream)
+    with stage("email"):
+        send_emails(username=login_username, password=password, messages=stream)
+
+
+# modules a command should only import once it needs them, see import-budget
+deferred_modules = [
+    "reportlab",
+    "qrcode",
+    "PIL",
+    "PyPDF2",
+    "openpyxl",
+    "smtplib",
+    "email.mime",
+    "dotenv",
+    "pdf_layout",
+    "delivery",
+    "memberhub",
+]
+
+
+def import_times(args):
+    """{module: cumulative microseconds} for every module imported running this script with args"""
+    import subprocess
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), *args],
+        capture_output=True,
+        text=True,
+    )
+    out = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        out[name.strip()] = (int(cumulative), len(name) - len(name.lstrip()))
+    return out
+
+
+@cli.command("import-budget")
+@click.option(
+    "--budget-ms",
+    default=150,
+    show_default=True,
+    type=int,
+    help="most milliseconds starting up may spend importing",
+)
+@click.argument("command", nargs=-1)
+@click.pass_context
+def import_budget(ctx, budget_ms=150, command=()):
+    """check what starting COMMAND (default: just --help) imports, and how long that takes
+
+    fails if startup imports take longer than --budget-ms, or if any of deferred_modules
+    is imported before a command has needed it
+    """
+    args = [*command, "--help"]
+    times = import_times(args)
+    # top level imports only, each already includes the time of what it imported
+    total_us = sum(us for us, depth in times.values() if depth == 1)
+
+    for name, (us, depth) in sorted(times.items(), key=lambda x: -x[1][0])[:10]:
+        if depth == 1:
+            print(f"{us / 1000:8.1f}ms {name}")
+    print(f"{total_us / 1000:8.1f}ms importing for {' '.join(args)}, budget {budget_ms}ms")
+
+    failed = total_us > budget_ms * 1000
+    for name in times:
+        if any(name == x or name.startswith(x + ".") for x in deferred_modules):
+            print(f"imported {name} at startup, it should be imported where it's used")
+            failed = True
+    if failed:
+        ctx.exit(1)
+    print("ok")
+
+
+# bump whenever synthetic_roster changes what it writes, so old generated workbooks are not reused
+BENCH_ROSTER_VERSION = 1
+
+bench_stages = ["load", "relations", "story", "layout", "memberhub"]
+
+
+def synthetic_roster(path, rows, seed=0):
+    """write an MCPS shaped export of about rows rows to path
+
+    one row per student per guardian, families of 1-3 guardians and 1-4 students sharing an
+    address, about 8% of families withholding their directory information, another 4%
+    withholding only some of their children, and a few SE PreK students (always dropped)
+    """
+    import random
+
+    from openpyxl import Workbook
+
+    rng = random.Random(seed)
+    labels = [
+        "Sch Num",
+        "School",
+        "Student",
+        "Student ID",
+        "Birth Date",
+        "Grade",
+        "Homeroom Teacher",
+        "Directory Withholding-YN",
+        "Phone",
+        "Home Address1",
+        "Home Address2",
+        "Relation",
+        "Parent/Guardian Name",
+        "Parent/Guardian Cell Phone",
+        "Parent/Guardian Email",
+    ]
+    grades = ["K", "1", "2", "3", "4", "5"]
+    # about 22 students per class, however large the school
+    classes_per_grade = max(1, rows // (2 * 3 * 22 * len(grades)))
+    teachers = {
+        grade: [f"Teacher{grade}{i:03d}, Pat" for i in range(classes_per_grade)]
+        for grade in grades
+    }
+    streets = ["Warwick Pl", "Dorset Ave", "Surrey St", "Essex Ave", "Cumberland Ave", "Trent St", "Stewart Ave", "Unitas St"]
+    units = ["", "", "", " Apt 2", " Unit 3B", " #4"]
+    lastnames = ["Smith", "Jones", "Lee", "de Bruin", "Garcia", "Patel", "Kim", "Nguyen", "O'Brien", "Davis"]
+    firstnames = ["Ann", "Bob", "Cy", "Dee", "Eli", "Fay", "Gus", "Hana", "Ivy", "Jo", "Kai", "Lu"]
+    relations = ["Mother", "Father", "Guardian", "Grandmother"]
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(labels)
+
+    written = 0
+    family = 0
+    student_id = 100000
+    while written < rows:
+        family += 1
+        lastname = f"{rng.choice(lastnames)}{family}"
+        address1 = f"{rng.randint(1, 9999)} {rng.choice(streets)}{rng.choice(units)}"
+        phone = f"301555{rng.randint(0, 9999):04d}"
+        guardians = [
+            (
+                rng.choice(relations),
+                f"{lastname}, {rng.choice(firstnames)}",
+                f"240555{rng.randint(0, 9999):04d}",
+                f"{lastname.lower().replace(' ', '').replace(chr(39), '')}.{g}@example.com",
+            )
+            for g in range(rng.choice([1, 2, 2, 2, 3]))
+        ]
+        family_withholding = rng.random() < 0.08
+        some_withheld = not family_withholding and rng.random() < 0.04
+        for _ in range(rng.choice([1, 1, 2, 2, 3, 4])):
+            student_id += 1
+            grade = rng.choice(grades)
+            if rng.random() < 0.005:
+                grade = "SE PreK"
+            teacher = rng.choice(teachers.get(grade) or teachers["K"])
+            withholding = family_withholding or (some_withheld and rng.random() < 0.5)
+            student = f"{lastname}, {rng.choice(firstnames)}"
+            for relation, name, cell, email in guardians:
+                ws.append(
+                    [
+                        "0123",
+                        "Somerset ES",
+                        student,
+                        str(student_id),
+                        f"{2013 + grades.index(grade) if grade in grades else 2019}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+                        grade,
+                        teacher,
+                        "Y" if withholding else "N",
+                        phone,
+                        address1,
+                        "Chevy Chase, MD 20815",
+                        relation,
+                        name,
+                        cell,
+                        email,
+                    ]
+                )
+                written += 1
+    wb.save(path)
+    return written
+
+
+def synthetic_roster_path(rows, seed=0):
+    """a generated workbook, reused while BENCH_ROSTER_VERSION is unchanged"""
+    path = (
+        pathlib.Path(cache_dir)
+        / "bench"
+        / f"roster-{rows}-seed{seed}-v{BENCH_ROSTER_VERSION}.xlsx"
+    )
+    if not path.is_file():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}.xlsx")
+        synthetic_roster(tmp_path, rows, seed=seed)
+        os.replace(tmp_path, path)
+    return path
+
+
+def bench_one(src, stages, trace_memory=False, verbose=False):
+    """run stages over src in this process, returns {stage: {wall, cpu, peak_rss_kb, ...}}
+
+    meant to run in a fresh process per roster, so peak_rss_kb (the high water mark so far)
+    belongs to this roster alone
+    """
+    import tracemalloc
+
+    global use_toc_cache
+    # every layout starts cold, as it would the first time a roster is seen
+    use_toc_cache = False
+
+    results = {"rows": None, "stages": {}}
+    state = {}
+    workdir = tempfile.TemporaryDirectory(prefix="pta-bench-")
+
+    def run(stage):
+        if stage == "load":
+            state["pool"] = xlsx_to_pool(src)
+        elif stage == "relations":
+            state["students"] = pool_to_student_relations(state["pool"])
+        elif stage == "story":
+            state["story"] = pool_to_story(state["pool"])
+        elif stage == "layout":
+            import pdf_layout
+
+            if not pdf_layout.cover_image.is_file():
+                print(f"no {pdf_layout.cover_image}, laying out without the cover picture")
+                pdf_layout.draw_cover_image = False
+            story_to_pdf(state["story"], filename=os.path.join(workdir.name, "bench.pdf"))
+        elif stage == "memberhub":
+            # writes ready_to_load.csv into the current directory
+            here = os.getcwd()
+            os.chdir(workdir.name)
+            try:
+                make_memberhub_import.main(
+                    ["--src", os.path.join(here, src), "-no-cache"],
+                    standalone_mode=False,
+                )
+            finally:
+                os.chdir(here)
+
+    # the stages asked for, and whatever they need run first (untimed in the results)
+    needs = {"relations": "load", "story": "load", "layout": "story"}
+    wanted = set(stages)
+    for stage in reversed(bench_stages):
+        if stage in wanted and stage in needs:
+            wanted.add(needs[stage])
+    todo = [stage for stage in bench_stages if stage in wanted]
+
+    for stage in todo:
+        if trace_memory:
+            tracemalloc.start()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            run(stage)
+        stats = {
+            "wall": time.perf_counter() - wall,
+            "cpu": time.process_time() - cpu,
+            "peak_rss_kb": peak_rss_kb(),
+        }
+        if trace_memory:
+            stats["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if stage in stages:
+            results["stages"][stage] = stats
+
+    if "pool" in state:
+        results["accepted"] = len(state["pool"])
+    if "students" in state:
+        results["students"] = len(state["students"])
+    workdir.cleanup()
+    return results
+
+
+def bench_git_commit():
+    import subprocess
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_bench_comparison(old, new):
+    old_runs = {run["rows"]: run for run in old.get("runs", [])}
+    print(f"compared to {old.get('commit')} ({old.get('date')})")
+    for run in new["runs"]:
+        old_run = old_runs.get(run["rows"])
+        if not old_run:
+            continue
+        for stage, stats in run["stages"].items():
+            old_stats = old_run["stages"].get(stage)
+            if not old_stats:
+                continue
+            ratio = stats["wall"] / old_stats["wall"] if old_stats["wall"] else 0
+            print(
+                f"{run['rows']:>8,d} rows {stage:<10} {old_stats['wall']:8.2f}s -> {stats['wall']:8.2f}s  x{ratio:.2f}"
+                + ("  SLOWER" if ratio > 1.2 else "")
+            )
+
+
+@cli.command("bench")
+@click.option(
+    "--rows",
+    multiple=True,
+    type=click.IntRange(min=1),
+    default=[500, 5000],
+    show_default=True,
+    help="roster size to generate and time, may be repeated (500 to 200000 are typical)",
+)
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(bench_stages),
+    help="only time this stage, may be repeated (default is all of them)",
+)
+@click.option("--seed", default=0, type=int, help="seed for the generated rosters")
+@click.option(
+    "--out", default="bench.json", show_default=True, help="where to write the results"
+)
+@click.option(
+    "--compare",
+    type=click.Path(exists=True, dir_okay=False),
+    help="an earlier --out to compare these results to",
+)
+@click.option(
+    "--trace-memory/-no-trace-memory",
+    default=False,
+    help="also record the python heap peak per stage (tracemalloc, slows everything down)",
+)
+@click.option(
+    "--verbose/-no-verbose", default=False, help="show what each stage prints"
+)
+@click.pass_context
+def bench(
+    ctx,
+    rows=(500, 5000),
+    stages=(),
+    seed=0,
+    out="bench.json",
+    compare=None,
+    trace_memory=False,
+    verbose=False,
+):
+    """time each stage of the pipeline on generated MCPS shaped rosters"""
+    import datetime
+    import json
+    import platform
+    from concurrent.futures import ProcessPoolExecutor
+
+    stages = list(stages) or bench_stages
+
+    report = {
+        "commit": bench_git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": seed,
+        "roster_version": BENCH_ROSTER_VERSION,
+        "runs": [],
+    }
+    for n in rows:
+        src = synthetic_roster_path(n, seed=seed)
+        # a fresh process per roster, so memory high water marks don't carry over
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            run = executor.submit(bench_one, str(src), stages, trace_memory, verbose).result()
+        run["rows"] = n
+        report["runs"].append(run)
+        for stage, stats in run["stages"].items():
+            print(
+                f"{n:>8,d} rows {stage:<10} {stats['wall']:8.2f}s wall {stats['cpu']:8.2f}s cpu {stats['peak_rss_kb'] / 1024:8.1f}MB peak rss"
+                + (
+                    f" {stats['python_peak_bytes'] / 1024 / 1024:8.1f}MB python peak"
+                    if "python_peak_bytes" in stats
+                    else ""
+                )
+            )
+
+    with open(out, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"wrote {out}")
+
+    if compare:
+        with open(compare) as fh:
+            print_bench_comparison(json.load(fh), report)
 
 
 if __name__ == "__main__":
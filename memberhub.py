@@ -0,0 +1,333 @@
+"""the MemberHub service, for posting the school calendar as MemberHub events
+
+    async with MemberHubClient(token, secret) as client:
+        failures = await post_calendar(client, organization_uuid, read_calendar("calendar.csv"))
+
+requests go out over a pool of at most concurrency keep-alive connections, each request
+running in a thread so the event loop is free to start the next. a request that couldn't
+be sent, a 429 or a 503 is retried with backoff. a POST isn't repeated once it has gone
+out, a lost reply or a 5xx from a gateway may still have created the event; anything
+else fails just that event. the session
+token and secret are the MemberHub-Session-* headers a logged in browser sends, and are
+replaced by any the service hands back. base_url can point at a local stand-in,
+e.g. MEMBERHUB_API_URL=http://localhost:8080
+"""
+
+import asyncio
+import csv
+import datetime
+import http.client
+import json
+import os
+import pathlib
+import time
+import urllib.parse
+import zoneinfo
+
+api_url = os.environ.get("MEMBERHUB_API_URL", "https://api.memberhub.co")
+events_path = "/services/memberhub-service/events"
+site_url = "https://somersetelementary.memberhub.com"
+timezone = "America/New_York"
+
+# worth another go, anything else won't change
+retry_statuses = {429, 500, 502, 503, 504}
+# turned away before anything was done, so worth another go even for a POST
+refused_statuses = {429, 503}
+idempotent_methods = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+class MemberHubError(Exception):
+    def __init__(self, status, reason, body=""):
+        super().__init__(" ".join(str(x) for x in (status, reason, body[:200]) if x))
+        self.status = status
+        self.body = body
+
+
+class SessionExpired(MemberHubError):
+    """the session token was refused, log in to MemberHub again and copy the new one"""
+
+
+class MemberHubClient:
+    """requests to the MemberHub service over up to concurrency pooled connections
+
+    each connection is opened on first use and kept for the requests after it, one at a
+    time. a request that can't get a connection waits for one, so no more than
+    concurrency are ever in flight however many are awaited at once
+    """
+
+    def __init__(
+        self,
+        token,
+        secret,
+        base_url=None,
+        concurrency=4,
+        retries=3,
+        backoff=1.0,
+        timeout=30,
+        keepalive=5,
+    ):
+        self.token = token
+        self.secret = secret
+        url = urllib.parse.urlsplit(base_url or api_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # a connection idle longer is reopened rather than risk a POST on one the server
+        # has already closed, which can't be retried
+        self.keepalive = keepalive
+        self.pool = None
+        # the SessionExpired that ended the session, later requests fail without trying
+        self.expired = None
+        self.opened = 0
+        self.requests = 0
+        self.retried = 0
+
+    async def __aenter__(self):
+        self.pool = asyncio.Queue()
+        for _ in range(self.concurrency):
+            # None is a connection not opened yet
+            self.pool.put_nowait(None)
+        return self
+
+    async def __aexit__(self, *exc):
+        while not self.pool.empty():
+            conn = self.pool.get_nowait()
+            if conn is not None:
+                conn.close()
+
+    def connect(self):
+        self.opened += 1
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def headers(self):
+        return {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "MemberHub-Session-Token": self.token,
+            "MemberHub-Session-Secret": self.secret,
+            "Origin": site_url,
+            "Referer": f"{site_url}/",
+        }
+
+    def send(self, conn, method, path, body):
+        """write a request on conn, in a worker thread. returns conn, which may be new"""
+        if conn is not None and time.monotonic() - conn.idle_since > self.keepalive:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self.connect()
+        conn.request(method, self.prefix + path, body=body, headers=self.headers())
+        return conn
+
+    def receive(self, conn):
+        """the reply to the request just sent on conn, in a worker thread"""
+        response = conn.getresponse()
+        data = response.read()
+        conn.idle_since = time.monotonic()
+        if response.will_close:
+            conn.close()
+            conn = None
+        return conn, response, data
+
+    async def request(self, method, path, payload=None):
+        """the decoded json reply to method path, sending payload as json"""
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        conn = await self.pool.get()
+        try:
+            for attempt in range(self.retries + 1):
+                if self.expired:
+                    raise self.expired
+                self.requests += 1
+                sent = False
+                wait = self.backoff * 2**attempt
+                try:
+                    conn = await asyncio.to_thread(self.send, conn, method, path, body)
+                    sent = True
+                    conn, response, data = await asyncio.to_thread(self.receive, conn)
+                except (OSError, http.client.HTTPException) as e:
+                    # reset, timed out or closed under us, the connection is gone
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+                    if sent and method not in idempotent_methods:
+                        raise MemberHubError(
+                            None, "no reply, it may or may not have been done", repr(e)
+                        ) from e
+                    if attempt == self.retries:
+                        raise
+                    error = repr(e)
+                else:
+                    self.refresh_session(response)
+                    text = data.decode("utf-8", errors="replace")
+                    if response.status < 300:
+                        return json.loads(text) if text.strip() else None
+                    if response.status in (401, 403):
+                        self.expired = SessionExpired(response.status, response.reason, text)
+                        raise self.expired
+                    retryable = (
+                        retry_statuses if method in idempotent_methods else refused_statuses
+                    )
+                    if response.status not in retryable or attempt == self.retries:
+                        raise MemberHubError(response.status, response.reason, text)
+                    error = f"{response.status} {response.reason}"
+                    retry_after = response.getheader("Retry-After")
+                    if retry_after and retry_after.isdigit():
+                        wait = max(wait, int(retry_after))
+                self.retried += 1
+                print(f"{error} from {method} {path}, retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
+        finally:
+            self.pool.put_nowait(conn)
+
+    def refresh_session(self, response):
+        token = response.getheader("MemberHub-Session-Token")
+        secret = response.getheader("MemberHub-Session-Secret")
+        if token:
+            self.token = token
+        if secret:
+            self.secret = secret
+
+    async def create_event(self, organization_uuid, event):
+        return await self.request(
+            "POST",
+            events_path,
+            {"event": event, "organization_uuid": organization_uuid},
+        )
+
+    async def create_events(self, organization_uuid, events):
+        """create every event at once, returns the reply or the exception for each, in order"""
+        return await asyncio.gather(
+            *(self.create_event(organization_uuid, event) for event in events),
+            return_exceptions=True,
+        )
+
+
+def read_calendar(path):
+    """the rows of a .csv, or the list of mappings in a .yaml (alone or under "events")
+
+    each row has name and date, and may have start and end (HH:MM, local time, an event
+    without a start is all day), location and public (true unless no/false/0)
+    """
+    path = pathlib.Path(path)
+    if path.suffix.lower() in (".yaml", ".yml"):
+        import yaml
+
+        with open(path, encoding="utf-8") as fh:
+            rows = yaml.safe_load(fh) or []
+        if isinstance(rows, dict):
+            rows = rows.get("events", [])
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as fh:
+            rows = list(csv.DictReader(fh))
+    return [
+        {key.strip().lower(): value for key, value in row.items() if key}
+        for row in rows
+    ]
+
+
+def as_utc(day, clock):
+    """day and clock in timezone as MemberHub's utc time, 2022-09-07 18:30 -> 2022-09-07T22:30:00.000Z"""
+    if isinstance(clock, int):
+        # yaml 1.1 reads an unquoted 18:30 as the base 60 number 1110
+        hour, minute = divmod(clock, 60)
+    else:
+        hour, minute = (int(x) for x in str(clock).split(":")[:2])
+    local = datetime.datetime.combine(
+        datetime.date.fromisoformat(str(day)),
+        datetime.time(hour, minute),
+        zoneinfo.ZoneInfo(timezone),
+    )
+    utc = local.astimezone(datetime.timezone.utc)
+    return utc.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def school_year(day):
+    """the July through June school year of day, as MemberHub describes it"""
+    tz = zoneinfo.ZoneInfo(timezone)
+    start_year = day.year if day.month >= 7 else day.year - 1
+    start = datetime.datetime(start_year, 7, 1, tzinfo=tz)
+    end = datetime.datetime(start_year + 1, 6, 30, 23, 59, 59, tzinfo=tz)
+    now = datetime.datetime.now(tz).replace(microsecond=0)
+    return {
+        "end_date": end.date().isoformat(),
+        "end_time": end.isoformat(),
+        "end_year": end.year,
+        "start_date": start.date().isoformat(),
+        "start_time": start.isoformat(),
+        "start_year": start.year,
+        "today": now.date().isoformat(),
+        "now": now.isoformat(),
+        "year": end.year,
+    }
+
+
+def calendar_event(row, organization_uuid):
+    """the event MemberHub's calendar page posts for a read_calendar row"""
+    day = datetime.date.fromisoformat(str(row["date"]))
+    start, end = row.get("start"), row.get("end")
+    if start:
+        starting_at = as_utc(day, start)
+        ending_at = as_utc(day, end) if end else starting_at
+    else:
+        starting_at = as_utc(day, "00:00")
+        ending_at = as_utc(day + datetime.timedelta(days=1), "00:00")
+    public = str(row.get("public", "true")).strip().lower() not in ("no", "false", "0")
+    year = school_year(day)
+    return {
+        "calendar": True,
+        "repeat_every": 1,
+        "remind_timeframe": "day",
+        "remind_hour": 9,
+        "timezone": timezone,
+        "name": row["name"],
+        "public": public,
+        "country": "US",
+        "state": "MD",
+        "location_name": row.get("location") or "",
+        "starting_at": starting_at,
+        "ending_at": ending_at,
+        "recipients": {
+            "everyone": False,
+            "organizations": [],
+            "officers": [],
+            "roles": [],
+            "stripe": [],
+            "traits": [],
+            "users": [],
+            "years": [],
+            "checked": [],
+            "recipients": [],
+            "organization": {"uuid": organization_uuid},
+            "school_year": year,
+            "current_school_year": school_year(datetime.date.today()),
+            "viewing_previous_year": False,
+            "year_difference": 0,
+            "role_names": ["admin", "member", "other", "student", "child", "officer", "customer"],
+        },
+    }
+
+
+async def post_calendar(client, organization_uuid, rows):
+    """create an event per row, returns [(row, error)] for those that failed"""
+    events = [calendar_event(row, organization_uuid) for row in rows]
+    started = time.perf_counter()
+    results = await client.create_events(organization_uuid, events)
+    elapsed = time.perf_counter() - started
+    failures = []
+    for row, result in zip(rows, results):
+        if isinstance(result, Exception):
+            failures.append((row, result))
+            print(f"FAILED\t{row['date']}\t{row['name']}\t{result!r}")
+        else:
+            print(f"ok\t{row['date']}\t{row['name']}")
+    print(
+        f"memberhub: {len(rows) - len(failures)} created, {len(failures)} failed in {elapsed:.1f}s, "
+        f"{client.requests} requests over {client.opened} connections, {client.retried} retried"
+    )
+    return failures
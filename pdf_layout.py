@@ -0,0 +1,758 @@
+"""the reportlab side of the directory: the page template, cover and page furniture, and
+the flowables of our own that go into a story
+
+make_directory.py imports this only in the commands that lay out or stamp pages, so the
+others don't pay for importing reportlab
+"""
+
+import functools
+import pathlib
+import re
+from collections import OrderedDict, namedtuple
+
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_RIGHT
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.pdfbase.pdfdoc import PDFObject, PDFString
+from reportlab.pdfbase.pdfmetrics import getAscentDescent, getFont, stringWidth
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Flowable, Paragraph, Table
+from reportlab.platypus.doctemplate import BaseDocTemplate, PageTemplate
+from reportlab.platypus.frames import Frame
+
+
+class MyDocTemplate(BaseDocTemplate):
+    def __init__(self, filename, onPage=None, **kw):
+        self.allowSplitting = 0
+        # (level, text, page, bookmark) of every heading laid out, as sent to the TOC
+        self.toc_entries = []
+        BaseDocTemplate.__init__(
+            self,
+            filename,
+            pagesize=(5.5 * inch, 8.5 * inch),
+            **kw,
+        )
+        template = PageTemplate(
+            "normal",
+            [directory_frame()],
+            onPage=onPage or AllPageSetup,
+        )
+        self.addPageTemplates(template)
+
+    def beforeDocument(self):
+        self.toc_entries = []
+
+    def afterFlowable(self, flowable):
+        "Registers TOC entries."
+        if isinstance(flowable, LaterTOCEntries):
+            for level, text, page, *key in flowable.entries:
+                E = (level, text, self.page + page, *key)
+                self.toc_entries.append(E)
+                self.notify("TOCEntry", E)
+            return
+
+        if flowable.__class__.__name__ == "Paragraph":
+            text = flowable.getPlainText()
+            style = flowable.style.name
+
+            if style == "TOCHeading1":
+                level = 0
+            elif style == "TOCHeading2":
+                level = 1
+            else:
+                return
+
+            E = [level, text, self.page]
+            # if we have a bookmark name append that to our notify data
+            bn = getattr(flowable, "_bookmarkName", None)
+            if bn is not None:
+                E.append(bn)
+            self.toc_entries.append(tuple(E))
+            self.notify("TOCEntry", tuple(E))
+
+
+def directory_frame():
+    return Frame(
+        x1=0.25 * inch,
+        y1=0.25 * inch,
+        width=5 * inch,
+        height=8 * inch,
+        id="Frame1",
+        # leftPadding=0.1 * inch,
+        # showBoundary=1,
+        showBoundary=0,
+    )
+
+
+DirectoryStyles = namedtuple(
+    "DirectoryStyles",
+    [
+        "toch1",
+        "h2",
+        "h3",
+        "normal",
+        "body_text",
+        "teacher",
+        "teacher_email",
+        "details_student_name",
+        "details_class_teacher",
+        "details_phone",
+        "details_address",
+        "student_street",
+        "student_teacher",
+        "centered_title",
+        "centered_subtitle",
+        "centered",
+        "right",
+    ],
+)
+
+FontMetrics = namedtuple("FontMetrics", ["ascent", "descent", "space_width"])
+
+# (fontName, fontSize) -> FontMetrics of every font directory_styles uses
+font_metrics = {}
+
+
+class FrozenParagraphStyle(ParagraphStyle):
+    """a ParagraphStyle that can't be changed, as it is shared by every story. clone() it
+    for a variation"""
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"style {self.name} is shared, clone() it to change {name}")
+
+    def clone(self, name, parent=None, **kw):
+        style = ParagraphStyle(name)
+        style.__dict__ = self.__dict__.copy()
+        style.name = name
+        style.parent = parent or self
+        style._setKwds(**kw)
+        return style
+
+
+def frozen(style):
+    frozen_style = FrozenParagraphStyle.__new__(FrozenParagraphStyle)
+    frozen_style.__dict__.update(style.__dict__)
+    return frozen_style
+
+
+@functools.lru_cache(maxsize=None)
+def directory_styles():
+    """every paragraph style in the directory, built once per process and frozen
+
+    pool_to_story used to build a sample stylesheet (twice) and a dozen ParagraphStyles
+    per story, so once per personalized copy, and set the alignment of its Heading1 and
+    Heading2 in place. the metrics of the fonts they use are loaded into font_metrics here
+    too, rather than on the first word laid out
+    """
+    sample = getSampleStyleSheet()
+
+    toch1 = ParagraphStyle(
+        name="TOCHeading1",
+        fontSize=14,
+        leading=16,
+        spaceBefore=10,
+        spaceAfter=10,
+    )
+    # tcoh2 = ParagraphStyle(
+    #     name="TOCHeading2",
+    #     fontSize=12,
+    #     leading=18,
+    #     spaceBefore=10,
+    #     spaceAfter=10,
+    # )
+
+    # h1 = ParagraphStyle(
+    #     name="Heading1",
+    #     fontSize=14,
+    #     leading=16,
+    #     spaceBefore=10,
+    #     spaceAfter=10,
+    # )
+    h2 = ParagraphStyle(
+        name="Heading2",
+        fontSize=12,
+        leading=18,  # fontName="Helvetica-Bold",
+        spaceBefore=10,
+        spaceAfter=10,
+    )
+    h3 = ParagraphStyle(
+        # firstLineIndent=30,
+        spaceBefore=10,
+        # spaceAfter=45,
+        name="Heading2",
+        fontSize=10,
+        leading=22,
+        fontName="Helvetica",
+    )
+
+    teacher = ParagraphStyle(
+        name="teacher",
+        fontSize=14,
+        leading=20,  # leftIndent=15
+        fontName="Helvetica-Bold",
+    )
+
+    teacher_email = ParagraphStyle(
+        name="teacher_email",
+        fontSize=14,
+        leading=20,
+        leftIndent=15,
+        # fontName="Helvetica-Bold",
+    )
+
+    details_student_name = ParagraphStyle(
+        name="studentName", fontSize=12, leading=15, leftIndent=0
+    )
+    details_class_teacher = ParagraphStyle(
+        name="details_teacher", fontSize=10, leftIndent=10  # leading=12,
+    )
+    details_phone = ParagraphStyle(
+        name="phone",
+        fontSize=10,
+        # leading=12,
+        leftIndent=10,
+    )
+    details_address = ParagraphStyle(
+        name="address",
+        fontSize=10,
+        # leading=12,
+        leftIndent=10,
+    )
+
+    student_street = ParagraphStyle(
+        name="studentStreet", fontSize=12, leading=14, leftIndent=20
+    )
+    student_teacher = ParagraphStyle(
+        name="studentTeacher", fontSize=12, leading=14, leftIndent=20
+    )
+
+    styles = DirectoryStyles(
+        toch1=toch1,
+        h2=h2,
+        h3=h3,
+        normal=sample["Normal"],
+        body_text=sample["BodyText"],
+        teacher=teacher,
+        teacher_email=teacher_email,
+        details_student_name=details_student_name,
+        details_class_teacher=details_class_teacher,
+        details_phone=details_phone,
+        details_address=details_address,
+        student_street=student_street,
+        student_teacher=student_teacher,
+        centered_title=sample["Heading1"].clone("Heading1", alignment=1),
+        centered_subtitle=sample["Heading2"].clone("Heading2", alignment=1),
+        centered=sample["Normal"].clone("Normal", alignment=1),
+        right=ParagraphStyle(name="right", parent=sample["Normal"], alignment=TA_RIGHT),
+    )
+
+    for style in styles:
+        key = (style.fontName, style.fontSize)
+        if key not in font_metrics:
+            getFont(style.fontName)
+            font_metrics[key] = FontMetrics(
+                *getAscentDescent(*key), stringWidth(" ", *key)
+            )
+    return DirectoryStyles(*map(frozen, styles))
+
+
+# the cover picture, looked for next to this file so it's found from any directory
+cover_image = pathlib.Path(__file__).resolve().with_name("somerset_es_mary_vinograd.jpg")
+# bench turns this off when cover_image isn't there, it doesn't change the timings
+draw_cover_image = True
+
+
+def AllPageSetup(canvas, doc):
+
+    canvas.saveState()
+
+    canvas.setAuthor("Somerset ES PTA")
+    canvas.setTitle("Somerset ES 2024-2025 Directory")
+
+    if doc.page == 1:
+        image_path = "somerset_es_directory_cover.jpg"
+        image_path = "somerset_es_directory_cover2.jpg"
+        image_path = "somerset-staff-photo-23-24-cropped.jpg"
+        image_path = str(cover_image)
+        page_width, page_height = canvas._pagesize
+        if draw_cover_image:
+            canvas.drawImage(
+                image_path,
+                0,
+                1.75 * inch,
+                width=5.5 * inch,
+                height=4 * inch,
+                preserveAspectRatio=True,
+            )
+
+        c = canvas
+
+        # Cover Page Text with Drop Shadow
+        shadow_offset = 0.025 * inch
+        c.setFillColorRGB(0, 0, 0)
+        c.setFont("Helvetica", 60)
+        c.drawString(
+            shadow_offset + 0.3 * inch, -shadow_offset + 7.25 * inch, "Somerset ES"
+        )
+        c.drawString(
+            shadow_offset + 1 * inch, -shadow_offset + 6.25 * inch, "Directory"
+        )
+
+        pos3_y = 0.75 * inch
+        c.drawString(shadow_offset + 0.8 * inch, -shadow_offset + pos3_y, "2024-2025")
+
+        c.setFillColorRGB(102 / 256, 153 / 256, 102 / 256)
+        c.drawString(0.3 * inch, 7.25 * inch, "Somerset ES")
+        c.drawString(1 * inch, 6.25 * inch, "Directory")
+        c.drawString(0.8 * inch, pos3_y, "2024-2025")
+
+        ## Draw a line
+        # c.setStrokeColorRGB(0,1,0.3) #choose your line color
+        # c.line(2,2,2*inch,2*inch)
+
+        ## Draw a rectangle
+        # c.setFillColorRGB(1,1,0) #choose fill colour
+        # c.rect(4*inch,4*inch,2*inch,3*inch, fill=1) #draw rectangle
+
+    else:
+
+        PageFurniture(canvas, doc.page, getattr(doc, "owner", None))
+
+        # header
+        # canvas.drawString(0.5 * inch, 8 * inch, doc.fund)
+        # canvas.drawRightString(10.5 * inch, 8 * inch, doc.report_info)
+
+        # footers
+
+    canvas.restoreState()
+
+
+def PageFurniture(canvas, page, owner=None):
+    """page number and owner of every page after the cover, shared by AllPageSetup and the
+    overlay that merged section layouts get"""
+    if page > 4:
+        canvas.drawCentredString(2.75 * inch, 0.2 * inch, "Page %d" % (page))
+    if owner:
+        canvas.setSubject(owner)
+        # canvas.drawString(0.5 * inch, 0.5 * inch, doc.owner)
+        OwnerStamp(canvas, page, owner)
+
+
+def NoPageSetup(canvas, doc):
+    """for sections laid out on their own, PageFurniture is stamped on after merging"""
+
+
+def OwnerStamp(canvas, page, owner):
+    """rotated owner text along the spine, shared by AllPageSetup and the overlay"""
+    canvas.saveState()
+    canvas.rotate(90)
+    fs = canvas._fontsize
+    canvas.translate(1, -fs / 1.2)  # canvas._leading?
+    canvas.drawString((3 + (page / 100)) * inch, -0.05 * inch, owner)
+    canvas.restoreState()
+
+
+class QRCode(Flowable):
+    """a 1 inch QR code for url
+
+    drawn as one path of filled rectangles, a run of dark modules per rectangle, so the
+    pdf carries a few hundred path operators rather than a multi-megapixel image.
+    matrix is rows of booleans (True is dark), it may be set any time before drawing
+    """
+
+    def __init__(self, url, matrix, size=1 * inch):
+        Flowable.__init__(self)
+        self.url = url
+        self.size = size
+        self.matrix = matrix
+        self.hAlign = "CENTER"
+
+    def wrap(self, availWidth, availHeight):
+        return self.size, self.size
+
+    def draw(self):
+        matrix = self.matrix
+        module = self.size / len(matrix)
+        path = self.canv.beginPath()
+        for r, row in enumerate(matrix):
+            y = self.size - (r + 1) * module
+            c = 0
+            while c < len(row):
+                if not row[c]:
+                    c += 1
+                    continue
+                start = c
+                while c < len(row) and row[c]:
+                    c += 1
+                path.rect(start * module, y, (c - start) * module, module)
+        self.canv.saveState()
+        self.canv.setFillColor(colors.black)
+        self.canv.drawPath(path, stroke=0, fill=1)
+        self.canv.restoreState()
+
+
+# guardian rows in Full Details, set in BodyText and indented by an empty first column
+relation_style = directory_styles().body_text
+relation_indent = 10
+relation_padding = 1
+relation_line_width = 0.25
+relation_table_style = [
+    ("LINEABOVE", (1, 0), (-1, -1), relation_line_width, colors.black),
+    ("LINEBELOW", (1, 0), (-1, -1), relation_line_width, colors.black),
+    ("LINEBEFORE", (2, 0), (-1, -1), relation_line_width, colors.black),
+    # ("GRID", (0,0), (-1, -1), 0.5, colors.black),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("LEFTPADDING", (0, 0), (0, -1), 0),
+    ("LEFTPADDING", (1, 0), (-1, -1), relation_padding),
+    # ('LEFTPADDING', (-1,0), (-1, -1), 1),
+    ("RIGHTPADDING", (0, 0), (-1, -1), relation_padding),
+    ("TOPPADDING", (0, 0), (-1, -1), 0),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
+    # ('FONTSIZE', (0, 0), (-1, -1), 16),
+    # ('leftIndent', (0, 0), (1, -1), 10)
+]
+
+# the guardian cells StudentRecord draws itself: plain text, or a single mailto/tel link
+plain_cell = re.compile(r"[^<>&]*")
+link_cell = re.compile(r'<a href="([^"<>&]*)">([^<>&]*)</a>')
+
+# (record, width) -> RecordLayout, so later passes and the other personalized copies don't
+# measure a student again. least recently used first out, so a district sized roster can't
+# grow it without limit
+record_layouts = OrderedDict()
+record_layouts_size = 1 << 14
+
+
+def relation_table(rows):
+    """the Table guardian rows were laid out with before StudentRecord, still used for
+    anything StudentRecord can't draw itself"""
+    cells = [
+        [Paragraph(value, relation_style) if value else None for value in row]
+        for row in rows
+    ]
+    col_widths = [relation_indent] + [None] * (len(rows[0]) - 2)
+    return Table(
+        cells, hAlign="RIGHT", colWidths=col_widths, style=relation_table_style
+    )
+
+
+def relation_column_widths(minimums, availWidth):
+    """widths of the guardian columns, as Table sizes columns whose colWidths are None
+
+    minimums are the widest word in each column plus padding. None when they don't fit,
+    then Table would squeeze them and split words, which StudentRecord leaves to Table
+    """
+    remaining = availWidth - relation_indent - sum(minimums)
+    if remaining <= 0:
+        return None
+    desired = (availWidth - relation_indent) / len(minimums)
+    widths = list(minimums)
+    wanting = []
+    total_desired = 0
+    effective_remaining = remaining
+    for col, minimum in enumerate(minimums):
+        if desired > minimum:
+            wanting.append((desired - minimum, minimum, desired, col))
+            total_desired += desired
+            effective_remaining += minimum
+    if wanting:
+        proportion = effective_remaining / total_desired
+        wanting.sort()
+        final = []
+        for disappointment, minimum, desired, col in wanting:
+            if proportion * desired < minimum:
+                total_desired -= desired
+                effective_remaining -= minimum
+                if total_desired:
+                    proportion = effective_remaining / total_desired
+            else:
+                final.append(col)
+        for col in final:
+            widths[col] = proportion * desired
+    return [relation_indent] + widths
+
+
+def break_cell(text, maxWidth):
+    """text broken into lines no wider than maxWidth as a Paragraph would, or None if a word
+    would have to be split"""
+    fontName, fontSize = relation_style.fontName, relation_style.fontSize
+    spaceWidth = font_metrics[fontName, fontSize].space_width
+    shrink = rl_config.spaceShrinkage * spaceWidth
+    lines = []
+    line = []
+    width = -spaceWidth
+    for word in text.split():
+        wordWidth = stringWidth(word, fontName, fontSize)
+        if wordWidth > maxWidth:
+            return None
+        if line and width + spaceWidth + wordWidth > maxWidth + shrink * len(line):
+            lines.append(" ".join(line))
+            line = []
+            width = -spaceWidth
+        line.append(word)
+        width += spaceWidth + wordWidth
+    if line:
+        lines.append(" ".join(line))
+    return lines
+
+
+class RecordLayout:
+    """what StudentRecord.wrap worked out for one width
+
+    heights of the paragraphs, then either rows of (height, [(x, href, lines)]) with the
+    column edges they were ruled at, or a table_height when the rows are left to a Table
+    """
+
+    def __init__(self, height, paragraph_heights, rows=None, edges=None, table_height=0):
+        self.height = height
+        self.paragraph_heights = paragraph_heights
+        self.rows = rows
+        self.edges = edges
+        self.table_height = table_height
+
+
+class StudentRecord(Flowable):
+    """a student in Full Details: their name, class, phone and address paragraphs, then a
+    ruled row per guardian
+
+    replaces KeepTogether([*paragraphs, Table(rows)]) and looks the same, but measures and
+    draws the guardian cells from string widths instead of a Table of Paragraphs. rows are
+    lists of cell markup (or None), behind an empty first column as before. the layout of
+    the last record_layouts_size records are kept in record_layouts, so measuring one again
+    is a dict lookup
+    """
+
+    def __init__(self, paragraphs, rows):
+        Flowable.__init__(self)
+        # named like KeepTogether's, so describe_flowable finds the student's name
+        self._content = paragraphs
+        self.rows = [list(row) for row in rows]
+        self.key = (
+            tuple((p.style.name, p.text) for p in paragraphs),
+            tuple(tuple(row) for row in rows),
+        )
+        self.layout = None
+
+    def getSpaceBefore(self):
+        return self._content[0].getSpaceBefore() if self._content else 0
+
+    def getSpaceAfter(self):
+        if self.rows or not self._content:
+            return 0
+        return self._content[-1].getSpaceAfter()
+
+    def wrap(self, availWidth, availHeight):
+        key = (self.key, availWidth)
+        layout = record_layouts.get(key)
+        if layout is None:
+            layout = record_layouts[key] = self.measure(availWidth)
+            if len(record_layouts) > record_layouts_size:
+                record_layouts.popitem(last=False)
+        else:
+            record_layouts.move_to_end(key)
+        self.layout = layout
+        self.width = availWidth
+        self.height = layout.height
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        """nothing, so the record moves to the next frame like KeepTogether's content. only
+        a record taller than a whole frame is split, into paragraphs and the Table"""
+        frame = getattr(self, "_frame", None)
+        self.wrap(availWidth, availHeight)
+        if frame is None or self.height <= frame._aH or not frame._atTop:
+            return []
+        if not self.rows:
+            return list(self._content)
+        return [*self._content, relation_table(self.rows)]
+
+    def measure(self, availWidth):
+        paragraph_heights = [p.wrap(availWidth, 0xFFFFFF)[1] for p in self._content]
+        height = sum(paragraph_heights)
+        if not self.rows:
+            return RecordLayout(height, paragraph_heights)
+        measured = self.measure_rows(availWidth)
+        if measured is None:
+            table_height = relation_table(self.rows).wrap(availWidth, 0xFFFFFF)[1]
+            return RecordLayout(
+                height + table_height, paragraph_heights, table_height=table_height
+            )
+        rows, edges = measured
+        return RecordLayout(
+            height + sum(row_height for row_height, cells in rows),
+            paragraph_heights,
+            rows,
+            edges,
+        )
+
+    def measure_rows(self, availWidth):
+        """([(height, [(x, href, lines)])], column edges), or None to leave it to a Table"""
+        fontName, fontSize = relation_style.fontName, relation_style.fontSize
+        cells = []
+        for row in self.rows:
+            parsed = []
+            for value in row[1:]:
+                if not value:
+                    parsed.append(None)
+                elif m := link_cell.fullmatch(value):
+                    parsed.append(m.groups())
+                elif plain_cell.fullmatch(value):
+                    parsed.append((None, value))
+                else:
+                    return None
+            cells.append(parsed)
+
+        padding = 2 * relation_padding
+        minimums = [
+            max(
+                [
+                    max(stringWidth(word, fontName, fontSize) for word in cell[1].split(" "))
+                    for cell in column
+                    if cell
+                ],
+                default=0,
+            )
+            + padding
+            for column in zip(*cells)
+        ]
+        widths = relation_column_widths(minimums, availWidth)
+        if widths is None:
+            return None
+        # hAlign="RIGHT", though the columns add up to availWidth give or take rounding
+        edges = [availWidth - sum(widths)]
+        for width in widths:
+            edges.append(edges[-1] + width)
+
+        rows = []
+        for parsed in cells:
+            laid_out = []
+            row_height = 0
+            for col, cell in enumerate(parsed, 1):
+                if not cell:
+                    continue
+                href, text = cell
+                lines = break_cell(text, widths[col] - padding)
+                if lines is None:
+                    return None
+                laid_out.append((edges[col] + relation_padding, href, lines))
+                row_height = max(row_height, len(lines) * relation_style.leading)
+            rows.append((row_height, laid_out))
+        return rows, edges
+
+    def draw(self):
+        canv = self.canv
+        layout = self.layout
+        y = self.height
+        for p, height in zip(self._content, layout.paragraph_heights):
+            p.wrap(self.width, 0xFFFFFF)
+            y -= height
+            p.drawOn(canv, 0, y)
+
+        if layout.rows is None:
+            if self.rows:
+                table = relation_table(self.rows)
+                table.wrap(self.width, 0xFFFFFF)
+                table.drawOn(canv, self.width - table._width, y - layout.table_height)
+            return
+
+        style = relation_style
+        canv.saveState()
+        canv.setFillColor(style.textColor)
+        canv.setFont(style.fontName, style.fontSize, style.leading)
+        top = y
+        for row_height, cells in layout.rows:
+            for x, href, lines in cells:
+                baseline = top - style.fontSize
+                for line in lines:
+                    canv.drawString(x, baseline, line)
+                    if href:
+                        width = stringWidth(line, style.fontName, style.fontSize)
+                        link_y = baseline - style.fontSize / 8.0
+                        canv.linkURL(
+                            href,
+                            (x, link_y, x + width, link_y + style.leading),
+                            relative=1,
+                        )
+                    baseline -= style.leading
+            top -= row_height
+
+        canv.setLineCap(1)
+        canv.setLineJoin(1)
+        canv.setStrokeColor(colors.black)
+        canv.setLineWidth(relation_line_width)
+        edges = layout.edges
+        top = y
+        for row_height, cells in layout.rows:
+            canv.line(edges[1], top, edges[-1], top)
+            canv.line(edges[1], top - row_height, edges[-1], top - row_height)
+            top -= row_height
+        for x in edges[2:-1]:
+            canv.line(x, top, x, y)
+        canv.restoreState()
+
+
+class LaterTOCEntries(Flowable):
+    """takes no space, tells the TOC about headings laid out in other documents
+
+    entries are (level, text, page, bookmark) with page counted from the page this
+    flowable lands on, so the front matter can list sections that follow it
+    """
+
+    def __init__(self, entries):
+        Flowable.__init__(self)
+        self.entries = entries
+
+    def wrap(self, availWidth, availHeight):
+        return 0, 0
+
+    def draw(self):
+        pass
+
+
+class NamedDestination(PDFObject):
+    """a bookmark written into links by name, rather than as the page it is on
+
+    so a link still works when the page it points to was laid out in another document.
+    the pages a name is on are collected from MergeableCanvas.destinations when merging
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.page_number = None
+        self.view = ("/Fit",)
+
+    def format(self, document):
+        return PDFString(self.name).format(document)
+
+    def xyz(self, left, top, zoom):
+        self.view = ("/XYZ", left, top, zoom)
+
+    def fit(self):
+        self.view = ("/Fit",)
+
+    def setPage(self, page):
+        pass
+
+
+class MergeableCanvas(Canvas):
+    """a canvas whose internal links and bookmarks survive being merged with other pdfs"""
+
+    def _bookmarkReference(self, name):
+        if name not in self._destinations:
+            self._destinations[name] = NamedDestination(name)
+        return self._destinations[name]
+
+    def bookmarkPage(self, key, **kw):
+        dest = Canvas.bookmarkPage(self, key, **kw)
+        dest.page_number = self.getPageNumber()
+        return dest
+
+    def destinations(self):
+        """{name: (page number, view)} for every bookmark defined in this document"""
+        return {
+            name: (dest.page_number, dest.view)
+            for name, dest in self._destinations.items()
+            if dest.page_number is not None
+        }
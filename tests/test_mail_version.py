@@ -0,0 +1,116 @@
+"""the recipient ledger's version follows the directory a family is sent, not the code
+
+each build runs in its own copy of the modules, one of them edited the way a change that
+doesn't touch the families' copies would be (a comment, the board list)
+"""
+
+import pathlib
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("reportlab")
+
+repo = pathlib.Path(__file__).resolve().parent.parent
+modules = ["make_directory.py", "pdf_layout.py", "addresses.py", "delivery.py"]
+
+build = """
+import sys
+import make_directory, pdf_layout
+
+make_directory.cache_dir = sys.argv[3]
+pdf_layout.draw_cover_image = False
+pool = make_directory.xlsx_to_pool(sys.argv[1])
+index = make_directory.DirectoryIndex(pool)
+layout_jobs = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+assert make_directory.directory_to_pdf(
+    pool, index=index, filename=sys.argv[2], layout_jobs=layout_jobs
+)
+print(make_directory.directory_version(pool, index=index))
+"""
+
+unsent = """
+import sys
+import make_directory
+
+make_directory.cache_dir = sys.argv[2]
+owners = ["Pat Parent <Pat@Example.com>", "other@example.com"]
+todo = [(owner, make_directory.personalized_filename(owner), True) for owner in owners]
+mailer = make_directory.DirectoryMailer(todo, "me@example.com", None, version=sys.argv[1])
+mailer.ledger = make_directory.open_mail_ledger()
+print(" ".join(owner for owner, filename, mail in mailer.unsent(todo)))
+"""
+
+
+def checkout(path, edit=None):
+    path.mkdir()
+    for name in modules:
+        shutil.copy(repo / name, path / name)
+    if edit:
+        with open(path / "make_directory.py", "a", encoding="utf-8") as fh:
+            fh.write(edit)
+    return path
+
+
+def run(checkout, script, *args):
+    result = subprocess.run(
+        [sys.executable, "-c", script, *map(str, args)],
+        cwd=checkout,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+@pytest.fixture(scope="module")
+def roster(tmp_path_factory):
+    sys.path.insert(0, str(repo))
+    try:
+        import make_directory
+    finally:
+        sys.path.remove(str(repo))
+    path = tmp_path_factory.mktemp("roster") / "roster.xlsx"
+    make_directory.synthetic_roster(path, 60, seed=1)
+    return path
+
+
+def test_unrelated_edit_keeps_the_version(tmp_path, roster):
+    before = checkout(tmp_path / "before")
+    after = checkout(tmp_path / "after", edit='\n# a comment\npta_board = ["someone@example.com"]\n')
+    cache = tmp_path / "cache"
+
+    version = run(before, build, roster, tmp_path / "before.pdf", cache)
+    assert run(after, build, roster, tmp_path / "after.pdf", cache) == version
+
+    # Pat was mailed that version by the first checkout, so the edited one only mails other
+    sys.path.insert(0, str(before))
+    try:
+        from delivery import RecipientLedger, normalize_address
+    finally:
+        sys.path.remove(str(before))
+    with RecipientLedger(cache / "mail" / "recipients.sqlite") as ledger:
+        ledger.record((normalize_address("pat@example.com"), version), ["pat@example.com"])
+    assert run(after, unsent, version, cache) == "other@example.com"
+
+
+def test_changed_directory_changes_the_version(tmp_path, roster):
+    code = checkout(tmp_path / "code")
+    cache = tmp_path / "cache"
+    version = run(code, build, roster, tmp_path / "a.pdf", cache)
+
+    with open(code / "pdf_layout.py", "a", encoding="utf-8") as fh:
+        fh.write("\nrelation_line_width = 0.5\n")
+    assert run(code, build, roster, tmp_path / "b.pdf", cache) != version
+
+
+def test_layout_jobs_keep_the_version(tmp_path, roster):
+    code = checkout(tmp_path / "code")
+    cache = tmp_path / "cache"
+    serial = run(code, build, roster, tmp_path / "serial.pdf", cache, 1)
+    merged = run(code, build, roster, tmp_path / "merged.pdf", cache, 2)
+    # laid out and merged differently, but the same directory as far as families go
+    assert (tmp_path / "serial.pdf").read_bytes() != (tmp_path / "merged.pdf").read_bytes()
+    assert merged == serial